@@ -3,6 +3,7 @@
 # File: drone_communication.py
 # Description: Module to handle serial communication to the drone from the GCS
 
+from link_protocol import FrameReader, encode_frame, unpack_telemetry, status_message, text_frames, TELEMETRY
 import serial
 import platform
 import calendar
@@ -10,9 +11,10 @@ import time
 
 
 class DroneComms:
-	def __init__(self):
+	def __init__(self, status_interval=1.0):
 		"""
 		Start wireless serial connection to drone
+		Telemetry arrives several times a second but is only shown as a status line every status_interval seconds
 		"""
 		if platform.system() == "Linux":
 			# Start a serial connection on a Linux laptop
@@ -34,6 +36,13 @@ class DroneComms:
 
 		# If an error is encountered here it will be handled in base_station.py
 
+		# The drone sends lines of text and binary frames - see link_protocol.py
+		self.frames = FrameReader()
+		self.sequence = 0  # Of the frames sent
+		self.telemetry = None  # Latest telemetry received as a dictionary
+		self.status_interval = status_interval
+		self.last_status = None  # When the last status line was returned
+
 		# Start handshake procedure
 		handshake_complete = False
 		print("HC-12 Connected - waiting for message from drone")
@@ -50,30 +59,54 @@ class DroneComms:
 				# Drone is online so send a response that GCS is too
 				epoch_string = str(calendar.timegm(time.localtime()))
 				print("Responding: " + "gcs_online&" + epoch_string)
-				self.send_message("gcs_online&" + epoch_string)
+				# The drone reads lines until the handshake is complete
+				self.ser.write(("gcs_online&" + epoch_string + "\n").encode('utf-8'))
 			elif received == "Handshake complete.":
 				# If the handshake is successful this will break the loop
 				handshake_complete = True
 
 	def read_message(self):
 		"""
-		Read the latest message from the serial buffer and return it
+		Read the oldest message received and return it
+		Telemetry frames are kept in self.telemetry and returned as the same status line the drone used to send,
+		at most once every status_interval seconds
 		Return None if no message available
 		"""
 		message_length = self.ser.in_waiting
 
 		if message_length > 0:
-			received = self.ser.readline().decode().strip()
-		else:
-			received = None
-
-		return received
+			self.frames.feed(self.ser.read(message_length))
+
+		received = self.frames.pop()
+		while received is not None:
+			frame_type, message = received
+			if frame_type is None:
+				return message
+			if frame_type == TELEMETRY:
+				self.telemetry = unpack_telemetry(message)
+				now = time.monotonic()
+				if self.last_status is None or now - self.last_status >= self.status_interval:
+					self.last_status = now
+					return status_message(self.telemetry)
+			# Skip telemetry between status lines and frame types this version doesn't know
+			received = self.frames.pop()
+
+		return None
 
 	def send_message(self, to_send):
 		"""
 		Send message to drone
+		Always sent in text frames so the drone never reads part of a corrupt frame as a command
+		"""
+		for frame_type, payload in text_frames(to_send):
+			self.ser.write(encode_frame(frame_type, self.sequence, payload))
+			self.sequence += 1
+
+	def get_link_stats(self):
+		"""
+		Return the number of lines and frames received, and the frames lost or corrupted
 		"""
-		self.ser.write((to_send + "\n").encode('utf-8'))
+		return dict(self.frames.stats)
 
 	def is_comms_open(self):
 		"""
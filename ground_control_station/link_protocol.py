@@ -0,0 +1,235 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: link_protocol.py
+# Description: Binary frames and packed telemetry for the HC-12 link, alongside the original lines of text.
+#              A copy of raspberry_pi/link_protocol.py - the two must be kept the same
+
+from collections import deque
+import binascii
+import struct
+import math
+
+# Every frame is SYNC, type, sequence, payload length, payload then a CRC-16/CCITT of type to payload.
+# SYNC is not ASCII so frames can be told apart from lines of text, which must stay ASCII.
+# Lines are only sent during the handshake - after that all text is framed, see FrameReader
+SYNC = b"\xaa\x55"
+HEADER = struct.Struct("<2sBBB")
+CRC = struct.Struct("<H")
+MAX_PAYLOAD = 255
+
+# Frame types
+TEXT = 1        # UTF-8 text, or the last part of it - see text_frames
+TELEMETRY = 2   # Packed telemetry - see pack_telemetry
+TEXT_PART = 3   # A part of some text that is continued in the next text frame
+
+# Flight states sent as an index into this tuple
+STATES = ("Initial", "Arming", "Ascending", "Traversing", "Descending", "Landing")
+
+# Packed telemetry: state, latitude and longitude in 1e-7 degrees, altitude in cm, distance left in dm,
+# groundspeed in cm/s, battery voltage in mV and current in cA. The largest value of a field means unknown
+TELEMETRY_FORMAT = struct.Struct("<BiihHHHH")
+TELEMETRY_FIELDS = (("lat", 1e7, 0x7FFFFFFF), ("lon", 1e7, 0x7FFFFFFF), ("alt", 100, 0x7FFF),
+					("distance_left", 10, 0xFFFF), ("groundspeed", 100, 0xFFFF), ("voltage", 1000, 0xFFFF),
+					("current", 100, 0xFFFF))
+
+
+def encode_frame(frame_type, sequence, payload):
+	if len(payload) > MAX_PAYLOAD:
+		raise ValueError("Frame payload is longer than " + str(MAX_PAYLOAD) + " bytes")
+	body = HEADER.pack(SYNC, frame_type, sequence % 256, len(payload)) + payload
+	return body + CRC.pack(binascii.crc_hqx(body[2:], 0xFFFF))
+
+
+def text_frames(text):
+	"""
+	Split text into the (frame type, payload) of each frame it is sent in. Each payload starts with the index
+	of its part so the reader can tell if one was lost, and all but the last part are TEXT_PART frames
+	"""
+	data = text.encode("utf-8")
+	size = MAX_PAYLOAD - 1
+	parts = [data[start:start + size] for start in range(0, len(data), size)] or [b""]
+	return [(TEXT if index == len(parts) - 1 else TEXT_PART, bytes((index % 256,)) + part)
+			for index, part in enumerate(parts)]
+
+
+def pack_telemetry(state, sample):
+	"""
+	Pack the flight state name and a Telemetry sample into 19 bytes
+	"""
+	values = [STATES.index(state) if state in STATES else 255]
+	for name, scale, unknown in TELEMETRY_FIELDS:
+		value = getattr(sample, name)
+		if math.isnan(value):
+			values.append(unknown)
+		else:
+			# Clamp to the range of the field, keeping clear of the unknown value
+			lowest = 0 if unknown == 0xFFFF else -unknown
+			values.append(min(max(round(value * scale), lowest), unknown - 1))
+	return TELEMETRY_FORMAT.pack(*values)
+
+
+def unpack_telemetry(payload):
+	"""
+	Return a dictionary of the state name and the telemetry fields in SI units, NaN if unknown
+	"""
+	values = TELEMETRY_FORMAT.unpack(payload)
+	telemetry = {"state": STATES[values[0]] if values[0] < len(STATES) else "Unknown"}
+	for (name, scale, unknown), value in zip(TELEMETRY_FIELDS, values[1:]):
+		telemetry[name] = math.nan if value == unknown else value / scale
+	return telemetry
+
+
+def status_message(telemetry):
+	"""
+	The same one line summary as Telemetry.status_message from an unpacked telemetry dictionary
+	"""
+	return "State: " + telemetry["state"].ljust(10) \
+		+ "  |  Altitude: " + "{:.2f}".format(telemetry["alt"]).ljust(6) \
+		+ "  |  Remaining Distance: " + "{:.0f}".format(telemetry["distance_left"]).ljust(4) \
+		+ "  |  Speed: " + "{:.2f}".format(telemetry["groundspeed"]).ljust(5) \
+		+ "  |  Battery Voltage (V): " + "{:.2f}".format(telemetry["voltage"]).ljust(5) \
+		+ "  |  Battery Current (A): " + "{:.0f}".format(telemetry["current"]).ljust(5)
+
+
+class FrameReader:
+	def __init__(self):
+		"""
+		Split the bytes received into lines of text and frames, whatever size pieces they arrive in.
+		A frame with a bad CRC is skipped by searching for the next SYNC, so one corrupt byte
+		never loses more than the frame it was in.
+		Lines are only read until the first frame arrives: after that everything is framed, so bytes outside
+		a frame are the remains of a corrupt one and are skipped rather than read as text
+		"""
+		self.buffer = bytearray()
+		self.received = deque()
+		self.last_sequence = None
+		self.framed = False  # Set by the first good frame
+		self.text = None  # The parts of some text received so far, None if waiting for the first part
+		self.next_part = 0
+		self.stats = {"Lines": 0, "Frames": 0, "Bad frames": 0, "Lost frames": 0, "Discarded bytes": 0}
+
+	def feed(self, data):
+		"""
+		Add received bytes. Return the number of complete lines and frames waiting to be popped
+		"""
+		self.buffer += data
+		buffer = self.buffer
+		while buffer:
+			if buffer[0] == SYNC[0]:
+				if len(buffer) < HEADER.size:
+					break
+				if buffer[1] != SYNC[1]:
+					self._resync()
+					continue
+				_, frame_type, sequence, length = HEADER.unpack_from(buffer)
+				end = HEADER.size + length
+				if len(buffer) < end + CRC.size:
+					break
+				if CRC.unpack_from(buffer, end)[0] != binascii.crc_hqx(buffer[2:end], 0xFFFF):
+					self.stats["Bad frames"] += 1
+					self._resync()
+					continue
+				self.framed = True
+				self._frame(frame_type, sequence, bytes(buffer[HEADER.size:end]))
+				del buffer[:end + CRC.size]
+			elif self.framed:
+				self._resync()
+			else:
+				newline = buffer.find(b"\n")
+				sync = buffer.find(SYNC[:1])
+				if newline != -1 and (sync == -1 or newline < sync):
+					line = buffer[:newline].decode("utf-8", "replace").strip()
+					del buffer[:newline + 1]
+					if line:
+						self.stats["Lines"] += 1
+						self.received.append((None, line))
+				elif sync != -1:
+					# The end of a line lost to noise
+					self._discard(sync)
+				else:
+					break
+		return len(self.received)
+
+	def _resync(self):
+		# Skip to the next SYNC without reading anything skipped as text
+		sync = self.buffer.find(SYNC[:1], 1)
+		self._discard(len(self.buffer) if sync == -1 else sync)
+
+	def _discard(self, count):
+		self.stats["Discarded bytes"] += count
+		del self.buffer[:count]
+
+	def _frame(self, frame_type, sequence, payload):
+		if self.last_sequence is not None:
+			self.stats["Lost frames"] += (sequence - self.last_sequence - 1) % 256
+		self.last_sequence = sequence
+		self.stats["Frames"] += 1
+		if frame_type in (TEXT, TEXT_PART):
+			self._text(frame_type, payload[0], payload[1:])
+		else:
+			self.received.append((frame_type, payload))
+
+	def _text(self, frame_type, index, part):
+		if index == 0:
+			self.text = bytearray()
+		elif self.text is None or index != self.next_part:
+			# An earlier part was lost so drop the rest of this text
+			self.text = None
+			return
+		self.text += part
+		self.next_part = (index + 1) % 256
+		if frame_type == TEXT:
+			self.received.append((None, self.text.decode("utf-8", "replace")))
+			self.text = None
+
+	def pop(self):
+		"""
+		Return the oldest (frame type, payload) received, with a frame type of None for text,
+		or None if nothing is waiting
+		"""
+		return self.received.popleft() if self.received else None
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+	from types import SimpleNamespace
+	import random
+
+	sample = SimpleNamespace(lat=52.3899529, lon=-1.5621087, alt=10.02, distance_left=123.4, groundspeed=4.52,
+							 voltage=16.2, current=math.nan)
+	frame = encode_frame(TELEMETRY, 0, pack_telemetry("Traversing", sample))
+	text = status_message(unpack_telemetry(pack_telemetry("Traversing", sample))) + "\n"
+
+	# 9600 baud with a start and stop bit is 960 bytes a second
+	print("Text status: " + str(len(text)) + " bytes, " + str(960 // len(text)) + " a second")
+	print("Telemetry frame: " + str(len(frame)) + " bytes, " + str(960 // len(frame)) + " a second")
+
+	# A handshake line then text and telemetry frames interleaved, with some bytes of the frames corrupted and
+	# delivered in random sized pieces. Nothing but the line and whole messages should come out as text
+	messages = ["Drone is landing", "Guidance timing: " + str(list(range(100)))]
+	handshake = b"drone_online\n"
+	stream = bytearray(handshake)
+	sequence = 0
+	for count in range(200):
+		for frame_type, payload in [(TELEMETRY, pack_telemetry("Traversing", sample))] \
+				+ (text_frames(messages[count // 10 % 2]) if count % 10 == 0 else []):
+			stream += encode_frame(frame_type, sequence, payload)
+			sequence += 1
+	for _ in range(20):
+		stream[random.randrange(len(handshake), len(stream))] ^= 0xFF
+
+	reader = FrameReader()
+	position = 0
+	while position < len(stream):
+		size = random.randint(1, 40)
+		reader.feed(bytes(stream[position:position + size]))
+		position += size
+	telemetry = [unpack_telemetry(payload) for frame_type, payload in reader.received if frame_type == TELEMETRY]
+	text = [payload for frame_type, payload in reader.received if frame_type is None]
+	print(reader.stats)
+	print(str(len(text)) + " text messages, " + str(sum(line not in messages + ["drone_online"] for line in text))
+		+ " of them garbage")
+	print(status_message(telemetry[-1]))
@@ -0,0 +1,142 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: black_box.py
+# Description: Crash safe recorder keeping the most recent telemetry in a fixed size memory mapped ring file
+
+from flight_log import LOG_DTYPE, make_header, make_trailer, read_header
+import numpy as np
+import threading
+import zlib
+import os
+
+# One slot of the ring. The checksum covers the sequence number and the record so a slot
+# that was only part written when the power went is found and dropped
+SLOT_DTYPE = np.dtype([("sequence", "<u8"),   # Starts at 1, 0 marks a slot that has never been written
+                       ("record", LOG_DTYPE),
+                       ("checksum", "<u4")])
+CHECKED_BYTES = SLOT_DTYPE.fields["checksum"][1]
+
+
+class BlackBox:
+    def __init__(self, path, minutes=10, rate=100, sync_interval=1.0):
+        """
+        Keep the last minutes of records logged at up to rate Hz in a ring of fixed size slots in the file at path.
+        The file is memory mapped so writing a record is a copy into memory; if the script is killed the
+        operating system still writes it out, and a thread syncs it to the SD card every sync_interval
+        in case the power is lost. Any previous recording is kept as path.old
+        """
+        self.path = path
+        self.capacity = int(minutes * 60 * rate)
+        if os.path.exists(path):
+            os.replace(path, path + ".old")
+
+        header = make_header(SLOT_DTYPE, capacity=self.capacity, kind="black box")
+        with open(path, "wb") as file:
+            file.write(header)
+            file.truncate(len(header) + self.capacity * SLOT_DTYPE.itemsize)
+        self.slots = np.memmap(path, dtype=SLOT_DTYPE, mode="r+", offset=len(header), shape=(self.capacity,))
+
+        self.sequence = 0
+        # The slot is built here then copied into the ring in one go
+        self._slot = np.zeros(1, dtype=SLOT_DTYPE)
+        self._checked = memoryview(self._slot.view(np.uint8))[:CHECKED_BYTES]
+
+        self.sync_interval = sync_interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sync, daemon=True)
+        self._thread.start()
+
+    def write(self, record):
+        """
+        Store a one element LOG_DTYPE array, overwriting the oldest record once the ring is full
+        """
+        self.sequence += 1
+        slot = self._slot[0]
+        slot["sequence"] = self.sequence
+        slot["record"] = record[0]
+        slot["checksum"] = zlib.crc32(self._checked)
+        self.slots[self.sequence % self.capacity] = slot
+
+    def _sync(self):
+        while not self._stop.wait(self.sync_interval):
+            self.slots.flush()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.slots.flush()
+        del self.slots
+
+
+def recover(path, output_path=None):
+    """
+    Rebuild a clean flight log from a black box file, e.g. after an unclean shutdown.
+    Slots with a bad checksum or in the wrong place for their sequence number are dropped.
+    Return the path of the new log and a dictionary describing what was recovered
+    """
+    if output_path is None:
+        output_path = os.path.splitext(path)[0] + "_recovered.flog"
+
+    with open(path, "rb") as file:
+        header, offset = read_header(file)
+    slots = np.memmap(path, dtype=header["dtype"], mode="r", offset=offset, shape=(header["capacity"],))
+
+    written = np.flatnonzero(slots["sequence"] > 0)
+    valid = [index for index in written
+             if slots["sequence"][index] % header["capacity"] == index
+             and zlib.crc32(slots[index:index + 1].tobytes()[:CHECKED_BYTES]) == slots["checksum"][index]]
+    valid = np.array(valid, dtype=np.int64)
+
+    # Oldest first
+    order = valid[np.argsort(slots["sequence"][valid])]
+    sequences = slots["sequence"][order]
+    records = slots["record"][order]
+
+    report = {"records": len(records),
+              "corrupt": len(written) - len(valid),
+              "gaps": int((np.diff(sequences) != 1).sum()) if len(sequences) else 0,
+              "first_sequence": int(sequences[0]) if len(sequences) else None,
+              "last_sequence": int(sequences[-1]) if len(sequences) else None,
+              "recovered_from": os.path.basename(path)}
+
+    with open(output_path, "wb") as file:
+        file.write(make_header(name=os.path.basename(output_path)))
+        file.write(np.ascontiguousarray(records).tobytes())
+        file.write(make_trailer(**report))
+
+    return output_path, report
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    from flight_log import read_log
+    import tempfile
+    import time
+
+    directory = tempfile.mkdtemp()
+    box = BlackBox(directory + "/black_box.bin", minutes=1, rate=50)
+
+    # Log for more than the minute the ring holds, then walk away without closing as if the Pi lost power
+    record = np.zeros(1, dtype=LOG_DTYPE)
+    start = time.perf_counter()
+    for tick in range(4000):
+        record["timestamp"] = tick * 0.02
+        record["current"] = tick % 30
+        box.write(record)
+    print("Mean write: {:.2f} us".format((time.perf_counter() - start) / 4000 * 1e6))
+    box.slots.flush()
+
+    # Tear one slot as if the power went part way through writing it
+    with open(box.path, "r+b") as file:
+        header, offset = read_header(file)
+        file.seek(offset + (3990 % box.capacity) * SLOT_DTYPE.itemsize + 20)
+        file.write(b"\xff" * 8)
+
+    path, report = recover(box.path)
+    header, records = read_log(path)
+    print(report)
+    print("Recovered {} records from t = {:.2f} s to {:.2f} s".format(
+        len(records), records["timestamp"][0], records["timestamp"][-1]))
@@ -3,18 +3,50 @@
 # File: data_logging.py
 # Description: Module to handle the logging of in flight data such as current readings against time.
 
-from datetime import datetime as dt
+from flight_log import LOG_DTYPE, make_header, make_trailer, index_entry
+from log_writer import LogSink, RotatingFile
+from black_box import BlackBox
+from telemetry import Telemetry, now, resync_clock
+from scheduler import Scheduler, SKIP
+import gzip
+import numpy as np
+import time
 import os
 from gpiozero import LED
 
 
 class DataLogging:
-    def __init__(self):
+    def __init__(self, sink_settings=None):
+        """
+        Files are written by LogSink threads so a stalled USB stick never holds up the caller.
+        Logs are gzip compressed by the sink threads in chunks of at most 5 s and moved
+        on to a new file every rotate_bytes of compressed data.
+        sink_settings gives the LogSink keyword arguments of the "USB" and "Backup" sinks
+        e.g. how often each one is synced to storage
+        """
         # Set up class attributes
         self.currently_logging = False
-        self.data_file = None
-        self.backup_file = None
+        self.sinks = {}
+        self.rotate_bytes = 1024 * 1024
+        chunk = {"compress_level": 6, "flush_interval": 5.0, "flush_bytes": 50 * LOG_DTYPE.itemsize}
+        self.sink_settings = {"USB": dict(chunk, fsync_interval=2.0),
+                              "Backup": dict(chunk, fsync_interval=5.0)}
+        if sink_settings is not None:
+            for sink, settings in sink_settings.items():
+                self.sink_settings[sink].update(settings)
         self.blue_led = LED(27)
+        self.blink_every = 1  # Records between blinks of the LED
+        # Each tick is packed into this one record and written as raw bytes - see flight_log.py
+        self.record = np.zeros(1, dtype=LOG_DTYPE)
+        self.records_logged = 0
+        # The last 10 minutes at up to 100 Hz are also kept in a crash safe ring - see black_box.py
+        self.black_box_path = os.path.dirname(os.path.abspath(__file__)) + "/logging/black_box.bin"
+        self.black_box = None
+
+        # High rate recording as a scheduler job - see start_recording
+        self.rate = None
+        self.scheduler = None
+        self.recording_job = None
 
     def prepare_for_logging(self, name):
         """
@@ -22,49 +54,108 @@ class DataLogging:
         write a header
         """
         self.currently_logging = True
+        self.records_logged = 0
+        self.rate = None
+        self.blink_every = 1  # Until start_recording sets a rate
+        self.recording_job = None
+        # Record timestamps on the same clock as the header's start time, in case it has been set since
+        resync_clock()
+
+        # Log to the memory stick and also to a backup locally in the logging folder
+        self.sinks = {}
+        paths = {"USB": "/media/usb_logger/" + name,
+                 "Backup": os.path.dirname(os.path.abspath(__file__)) + "/logging/" + name}
+
+        # Every file starts with the self describing header. log_to_csv.py converts them back to CSV
+        header = make_header(name=name)
+
+        for sink, path in paths.items():
+            settings = self.sink_settings[sink]
+            compressed = settings.get("compress_level") is not None
+            try:
+                if sink == "USB":
+                    # Mount memory stick to open the file on it
+                    os.system("sudo mount /dev/disk/by-uuid/0177-74FD /media/usb_logger -o noauto,users,rw,umask=0")
+                # Each part gets a sidecar index so flight_log.read_window can seek straight to any time
+                file = RotatingFile(path, ".flog.gz" if compressed else ".flog",
+                                    gzip.compress(header) if compressed else header, self.rotate_bytes, index=True)
+            except OSError:
+                # Carry on without the memory stick but never without the backup
+                if sink == "USB":
+                    continue
+                raise
+            self.sinks[sink] = LogSink(file, indexer=index_entry, **settings)
+
+        # The previous flight's black box is kept as black_box.bin.old until the next flight
+        self.black_box = BlackBox(self.black_box_path, minutes=10, rate=100)
+
+    def log_info(self, telemetry):
+        """
+        function should save information to a file in appropriate format
+        Input is the Telemetry sample for this tick
+        """
+        # Blink the LED quickly whenever data is written to the files, at most about 10 times a second
+        if self.records_logged % self.blink_every == 0:
+            self.blue_led.blink(on_time=0.05, n=1)
+        self.records_logged += 1
+
+        self.record[0] = (telemetry.timestamp, telemetry.lon, telemetry.lat, telemetry.alt,
+                          (telemetry.velocity_north, telemetry.velocity_east, telemetry.velocity_down),
+                          telemetry.groundspeed, telemetry.airspeed, telemetry.current, telemetry.voltage)
+        if self.black_box is not None:
+            self.black_box.write(self.record)
+
+        # Only queues the bytes - the files are written by the sink threads
+        data = self.record.tobytes()
+        for sink in self.sinks.values():
+            sink.put(data)
+
+    def start_recording(self, scheduler, read_state, rate=50):
+        """
+        Log at rate Hz as a job on the scheduler instead of from the caller's tick.
+        read_state() must return the latest Telemetry e.g. FlightController.get_state.
+        The job skips any deadlines it misses rather than bunching up - see scheduler.py
+        """
+        self.rate = rate
+        self.blink_every = max(1, round(rate / 10))
+        self.scheduler = scheduler
+        self.recording_job = scheduler.add("logging", 1 / rate, self._record, read_state, priority=2, policy=SKIP)
 
-        try:
-            # Mount memory stick and open file on it
-            os.system("sudo mount /dev/disk/by-uuid/0177-74FD /media/usb_logger -o noauto,users,rw,umask=0")
-            self.data_file = open("/media/usb_logger/" + name + ".csv", "w+")
-        except:
-            pass
+    def _record(self, read_state):
+        self.log_info(read_state())
+
+    def stop_recording(self):
+        if self.scheduler is not None:
+            self.scheduler.remove("logging")
+            self.scheduler = None
 
-        # Also create a backup file locally in the logging folder
-        self.backup_file = open(os.path.dirname(os.path.abspath(__file__)) + "/logging/" + name + ".csv", "w+")
+    def get_timing(self):
+        """
+        Return the number of recording ticks, the deadlines missed and the jitter of the tick start times in ms
+        """
+        if self.recording_job is None:
+            return {"Rate": self.rate, "Runs": 0}
+        return dict(self.recording_job.get_stats(), Rate=self.rate)
 
-        # Write the headers of each file
-        for file in self.data_file, self.backup_file:
-            file.write("Logging started at " + dt.now().strftime("%d-%m-%y at %H:%M:%S\n"))
-            file.write("Timestamp, Longitude, Latitude, Altitude, Velocity, Groundspeed, Airspeed, Current, Voltage\n")
+    def get_stats(self):
+        """
+        Return the queue depth, drops and write latency of each file being written
+        """
+        return {name: sink.get_stats() for name, sink in self.sinks.items()}
 
-    def log_info(self, current, fc_data_in):
+    def finish_logging(self, **info):
         """
-        function should save information to a file in appropriate format
-        Inputs contain a string current and a dictionary of data from the FC
-        """
-        # Blink the LED quickly whenever data is written to the files
-        self.blue_led.blink(on_time=0.05, n=1)
-
-        data = {"Timestamp": dt.now().strftime("%H:%M:%S.%f"),
-                "Location lon": fc_data_in["Location lon"],
-                "Location lat": fc_data_in["Location lat"],
-                "Location alt": fc_data_in["Location alt"],
-                "Velocity": "\"" + fc_data_in["Velocity"] + "\"",
-                "Ground Speed": fc_data_in["Groundspeed"],
-                "Airspeed": fc_data_in["Airspeed"],
-                "Current": str(current),
-                "Voltage": fc_data_in["Battery"]}
-
-        self.data_file.write(', '.join(data.values()) + "\n")
-        self.backup_file.write(', '.join(data.values()) + "\n")
-        
-    def finish_logging(self):
-        """
-        flight finished, close file
-        """
-        self.data_file.close()
-        self.backup_file.close()
+        flight finished, write out anything still queued and close the files.
+        Each file ends with a trailer of the number of records, the recording timing
+        and any keyword arguments given e.g. the flight's instrumentation
+        """
+        self.stop_recording()
+        trailer = make_trailer(records=self.records_logged, timing=self.get_timing(), **info)
+        for sink in self.sinks.values():
+            sink.close(trailer)
+        if self.black_box is not None:
+            self.black_box.close()
+            self.black_box = None
         try:
             # Unmount the USB stick so that it can be safely removed
             os.system("sudo umount /media/usb_logger")
@@ -84,16 +175,15 @@ class DataLogging:
 
 def log_random():
     # A local function for logging random data in the test bench
-    data = {"Timestamp": dt.now().strftime("%H:%M:%S.%f"),
-            "Location lon": "Location lon",
-            "Location lat": "Location lat",
-            "Location alt": "Location alt",
-            "Velocity": str(randint(1, 10)),
-            "Groundspeed": str(randint(1, 10)),
-            "Airspeed": str(randint(1, 10)),
-            "Battery": str(randint(14, 17))}
+    sample = Telemetry()
+    sample.timestamp = now()
+    sample.velocity_north, sample.velocity_east, sample.velocity_down = randint(1, 10), randint(1, 10), 0
+    sample.groundspeed = randint(1, 10)
+    sample.airspeed = randint(1, 10)
+    sample.current = 90
+    sample.voltage = randint(14, 17)
 
-    data_logging.log_info(90, data)
+    data_logging.log_info(sample)
 
 
 ########################################
@@ -102,14 +192,13 @@ def log_random():
 
 if __name__ == "__main__":
     from random import randint
-    from recurring_timer import RecurringTimer
-    import time
 
-    scheduler = RecurringTimer(0.1, log_random)
+    scheduler = Scheduler()
+    scheduler.start()
     data_logging = DataLogging()
     data_logging.prepare_for_logging("test_bench")
 
-    scheduler.start()
+    scheduler.add("random", 0.1, log_random)
     print("Logging started")
 
     # Add a minimum logging time
@@ -117,7 +206,22 @@ if __name__ == "__main__":
 
     while True:
         if input("Hit enter to finish logging!") == "":
-            scheduler.stop()
+            scheduler.remove("random")
             data_logging.finish_logging()
             print("Logging stopped")
+            print(data_logging.get_stats())
             break
+
+    # Then record at 100 Hz by reading the telemetry from the logging job itself and check the timing
+    def read_random():
+        sample = Telemetry()
+        sample.timestamp = now()
+        sample.current = randint(0, 30)
+        return sample.freeze()
+
+    data_logging.prepare_for_logging("test_bench_100hz")
+    data_logging.start_recording(scheduler, read_random, rate=100)
+    time.sleep(5)
+    data_logging.finish_logging()
+    scheduler.stop()
+    print(data_logging.get_timing())
@@ -0,0 +1,107 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: descriptor_bank.py
+# Description: Module to precompute and cache ORB descriptors of a landing pad over several scales and rotations
+
+import cv2
+import numpy as np
+import hashlib
+import os
+
+# One row per keypoint. The point is in the coordinates of the original, unscaled and unrotated,
+# pad image so that a homography from any match maps the pad straight into the ground image
+BANK_DTYPE = np.dtype([("descriptor", np.uint8, 32),
+                       ("point", np.float32, 2),
+                       ("scale", np.float32),
+                       ("rotation", np.float32)])
+
+DEFAULT_SCALES = (0.65, 0.9, 1.25, 1.75, 2.5)
+DEFAULT_ROTATIONS = (0, 45, 90, 135, 180, 225, 270, 315)
+
+
+def build_bank(target_grey, features=100, scales=DEFAULT_SCALES, rotations=DEFAULT_ROTATIONS):
+    """
+    Compute ORB features of the pad image at every combination of scale and rotation.
+    Return a structured array with BANK_DTYPE
+    """
+    orb = cv2.ORB_create(features)
+    height, width = target_grey.shape
+    rows = []
+
+    for scale in scales:
+        for rotation in rotations:
+            # Make the canvas big enough to hold the pad at any rotation
+            size = int(np.ceil(max(height, width) * scale * 1.5))
+            transform = cv2.getRotationMatrix2D((width / 2, height / 2), rotation, scale)
+            transform[:, 2] += (size / 2 - width / 2, size / 2 - height / 2)
+            # Mid grey surround so the canvas edge doesn't create features of its own
+            variant = cv2.warpAffine(target_grey, transform, (size, size), borderValue=127)
+
+            keypoints, descriptors = orb.detectAndCompute(variant, None)
+            if descriptors is None:
+                continue
+
+            # Map the keypoints back into the original pad image and drop any found outside it
+            points = cv2.KeyPoint_convert(keypoints).reshape(-1, 1, 2)
+            points = cv2.transform(points, cv2.invertAffineTransform(transform)).reshape(-1, 2)
+            inside = (points[:, 0] >= 0) & (points[:, 0] < width) & (points[:, 1] >= 0) & (points[:, 1] < height)
+
+            variant_rows = np.zeros(int(inside.sum()), dtype=BANK_DTYPE)
+            variant_rows["descriptor"] = descriptors[inside]
+            variant_rows["point"] = points[inside]
+            variant_rows["scale"] = scale
+            variant_rows["rotation"] = rotation
+            rows.append(variant_rows)
+
+    return np.concatenate(rows)
+
+
+def cache_path(image_path, features, scales, rotations):
+    """
+    The cache file name includes a hash of the pad image and the bank settings
+    so a stale bank is never loaded after either changes
+    """
+    digest = hashlib.sha1()
+    with open(image_path, "rb") as file:
+        digest.update(file.read())
+    digest.update(repr((features, tuple(scales), tuple(rotations))).encode("utf-8"))
+    base = os.path.splitext(image_path)[0]
+    return base + "_bank_" + digest.hexdigest()[:12] + ".npy"
+
+
+def load_bank(image_path, features=100, scales=DEFAULT_SCALES, rotations=DEFAULT_ROTATIONS):
+    """
+    Return the descriptor bank for the pad image, memory mapped from the cache file.
+    The bank is built and saved the first time it is needed
+    """
+    path = cache_path(image_path, features, scales, rotations)
+
+    if not os.path.exists(path):
+        target_grey = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        bank = build_bank(target_grey, features, scales, rotations)
+        # Write to a temporary file first so an interrupted save never leaves a corrupt cache
+        np.save(path + ".tmp.npy", bank)
+        os.replace(path + ".tmp.npy", path)
+
+    return np.load(path, mmap_mode="r")
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    import time
+
+    image_path = os.path.dirname(os.path.realpath(__file__)) + "/images/landing_image.png"
+    target = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+
+    start = time.perf_counter()
+    bank = build_bank(target)
+    print("Built bank of " + str(len(bank)) + " descriptors (" + str(bank.nbytes // 1024) + " kB) in "
+          + str(round((time.perf_counter() - start) * 1000)) + " ms")
+
+    load_bank(image_path)
+    start = time.perf_counter()
+    bank = load_bank(image_path)
+    print("Loaded cached bank in " + str(round((time.perf_counter() - start) * 1000, 2)) + " ms")
@@ -5,10 +5,26 @@
 
 import dronekit
 from pymavlink import mavutil
+from telemetry import Telemetry, GROUPS, now
+from instrumentation import timed
+import threading
+import asyncio
 import time
 import os
 import math
 
+# MAVLink messages the vehicle state is built from, the group of fields each one updates
+# and how to convert it to the fields in the order of telemetry.GROUPS, in SI units
+MESSAGES = {
+    "GLOBAL_POSITION_INT": ("position", lambda msg: (msg.lat / 1e7, msg.lon / 1e7, msg.relative_alt / 1000,
+                                                     msg.vx / 100, msg.vy / 100, msg.vz / 100)),
+    "ATTITUDE": ("attitude", lambda msg: (msg.roll, msg.pitch, msg.yaw)),
+    "VFR_HUD": ("speed", lambda msg: (msg.groundspeed, msg.airspeed)),
+    "SYS_STATUS": ("battery", lambda msg: (msg.voltage_battery / 1000,
+                                           math.nan if msg.current_battery == -1 else msg.current_battery / 100)),
+    "RANGEFINDER": ("rangefinder", lambda msg: (msg.distance,))
+}
+
 
 class FlightController:
     def __init__(self):
@@ -54,15 +70,32 @@ class FlightController:
         # Define class attributes
         self.mission_lat = None
         self.mission_lon = None
+        self.mission_location = None
         self.mission_height = 10
+        self.destination_listeners = []  # Called with the location name whenever the destination is set
+
+        # Vehicle state store, written by the MAVLink message listeners - see get_state.
+        # Start from the state dronekit already has so nothing is NaN once connected
+        self._live = self.read_telemetry()
+        self._distance_time = None  # position_time of the position distance_left was calculated from
+        self._state_lock = threading.Lock()
+        self.subscribers = []  # Called with the group name and a snapshot whenever values change
+        for message in MESSAGES:
+            self.vehicle.add_message_listener(message, self._on_message)
 
     def set_destination(self, location):
         """
         Takes in a string of a location from a predefined list.
         E.g. "bluebell", "claycroft", "test_point_A", "test_point_B"
+        Listeners are told so they can get ready for the location e.g. preload its landing pad
         """
         self.mission_lat = self.locations[location][0]
         self.mission_lon = self.locations[location][1]
+        self.mission_location = dronekit.LocationGlobalRelative(self.mission_lat, self.mission_lon,
+                                                                self.mission_height)
+        self._distance_time = None
+        for listener in self.destination_listeners:
+            listener(location)
 
     def land(self):
         """
@@ -85,14 +118,91 @@ class FlightController:
         """
         Returns true or false if the battery is connected
         """
-        if 10 < self.vehicle.battery.voltage < 20:  # When no battery the battery voltage comes out to be around 0.7V
+        if 10 < self.get_state().voltage < 20:  # When no battery the battery voltage comes out to be around 0.7V
             return True
         else:
             return False
 
+    async def wait_until(self, condition, group):
+        """
+        Wait until condition() is true without polling, checking it whenever the values of a group
+        of the vehicle state change e.g. "battery" or "position". Use asyncio.wait_for for a timeout
+        """
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def subscriber(name, state):
+            # Called from dronekit's thread
+            if name == group:
+                loop.call_soon_threadsafe(changed.set)
+
+        self.subscribers.append(subscriber)
+        try:
+            while not condition():
+                await changed.wait()
+                changed.clear()
+        finally:
+            self.subscribers.remove(subscriber)
+
+    def _on_message(self, vehicle, name, message):
+        """
+        dronekit message listener. Write the message's values into the state store
+        and tell the subscribers if any of them changed
+        """
+        received = now()
+        group, convert = MESSAGES[name]
+        values = convert(message)
+        live = self._live
+        with self._state_lock:
+            changed = False
+            for field, value in zip(GROUPS[group], values):
+                if getattr(live, field) != value:
+                    setattr(live, field, value)
+                    changed = True
+            setattr(live, group + "_time", received)
+
+        if changed and self.subscribers:
+            state = self.get_state()
+            for subscriber in tuple(self.subscribers):
+                subscriber(group, state)
+
+    @timed("read_telemetry")
+    def read_telemetry(self, sample=None):
+        """
+        Poll the vehicle state from dronekit into a Telemetry sample, refilling the one given rather than making
+        a new one. get_state is much cheaper as the message listeners keep the state up to date
+        """
+        if sample is None:
+            sample = Telemetry()
+        sample.update(self.vehicle)
+        if self.mission_location is None:
+            sample.distance_left = math.nan
+        else:
+            sample.distance_left = get_distance_metres(sample, self.mission_location)
+        return sample
+
+    def get_state(self):
+        """
+        Return a read only TelemetrySnapshot of the latest vehicle state including the distance left.
+        Nothing is read from the vehicle: the state is kept up to date by MAVLink message listeners and each
+        group of fields has the time it was received. The distance left is only calculated when a new position
+        arrives so logging, reporting and control all share it
+        """
+        with self._state_lock:
+            live = self._live
+            if live.position_time != self._distance_time:
+                self._distance_time = live.position_time
+                if self.mission_location is None:
+                    live.distance_left = math.nan
+                else:
+                    live.distance_left = get_distance_metres(live, self.mission_location)
+            live.timestamp = now()
+            return live.freeze()
+
+    @timed("get_fc_stats")
     def get_fc_stats(self):
         """
-        Return a dictionary containing all of the flight controller information including:
+        Return a dictionary containing all of the flight controller information as strings including:
             - Global Location
             - Velocity
             - GPS
@@ -100,16 +210,17 @@ class FlightController:
             - Groundspeed
             - Airspeed
         """
+        sample = self.get_state()
         fc_data = {
-            "Location lat": str(self.vehicle.location.global_frame.lat),
-            "Location lon": str(self.vehicle.location.global_frame.lon),
-            "Location alt": str(self.vehicle.location.global_relative_frame.alt),
-            "Range Finder Height": str(self.vehicle.rangefinder),
-            "Distance to waypoint": str(self.get_distance_left()),
-            "Velocity": str(self.vehicle.velocity),
-            "Battery": str(self.vehicle.battery.voltage),
-            "Groundspeed": str(self.vehicle.groundspeed),
-            "Airspeed": str(self.vehicle.airspeed)
+            "Location lat": str(sample.lat),
+            "Location lon": str(sample.lon),
+            "Location alt": str(sample.alt),
+            "Range Finder Height": str(sample.rangefinder),
+            "Distance to waypoint": str(sample.distance_left),
+            "Velocity": str([sample.velocity_north, sample.velocity_east, sample.velocity_down]),
+            "Battery": str(sample.voltage),
+            "Groundspeed": str(sample.groundspeed),
+            "Airspeed": str(sample.airspeed)
         }
 
         return fc_data
@@ -153,23 +264,15 @@ class FlightController:
 
     def get_distance_left(self):
         """
-        Return the horizontal distance to the next waypoint
+        Return the horizontal distance to the next waypoint, NaN if there isn't one
         """
-        try:
-            lat = self.mission_lat
-            lon = self.mission_lon
-            alt = self.mission_height
-            mission_location = dronekit.LocationGlobalRelative(lat, lon, alt)
-
-            return get_distance_metres(self.vehicle.location.global_frame, mission_location)
-        except:
-            return "No distance data"
+        return self.get_state().distance_left
 
     def get_altitude(self):
         """
-        Returns the current flight altitude as an integer
+        Returns the current flight altitude
         """
-        return self.vehicle.location.global_relative_frame.alt
+        return self.get_state().alt
 
     def change_flight_mode(self, flight_mode):
         """
@@ -180,6 +283,7 @@ class FlightController:
         else:
             print("Invalid flight mode sent")
 
+    @timed("move_relative")
     def move_relative(self, velocity_x, velocity_y, velocity_z, yaw):
         """
         Provide low level 'joystick style' commands to the drone.
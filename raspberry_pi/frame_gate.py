@@ -0,0 +1,111 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: frame_gate.py
+# Description: Module to reject unusable camera frames before they reach the expensive feature matcher
+
+import cv2
+import numpy as np
+from collections import deque
+import math
+
+# Order of the counters returned by FrameGate.get_counts
+GATE_RESULTS = ("Accepted", "Attitude", "Blur", "Exposure")
+
+
+class FrameGate:
+    def __init__(self, max_tilt=10, min_sharpness=0.6, sharpness_floor=50, history=15, width=640,
+                 min_brightness=30, max_brightness=225, max_clipped=0.25):
+        """
+        Cheap checks on each frame in increasing order of cost, made on a copy shrunk to about width pixels wide.
+        max_tilt is the largest roll or pitch in degrees at which the camera still points close enough to down.
+        Sharpness is the variance of the Laplacian. How sharp a frame can be depends on the ground in view,
+        so a frame is treated as motion blurred if it is less than min_sharpness times the median of
+        the last history frames, or less than sharpness_floor at all.
+        Brightness limits are on the mean grey level and max_clipped is the largest fraction of
+        pixels allowed to be pure black or white
+        """
+        self.max_tilt = math.radians(max_tilt)
+        self.min_sharpness = min_sharpness
+        self.sharpness_floor = sharpness_floor
+        self.sharpness = deque(maxlen=history)
+        self.width = width
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.max_clipped = max_clipped
+        self.counts = dict.fromkeys(GATE_RESULTS, 0)
+
+    def check(self, frame, roll=0.0, pitch=0.0):
+        """
+        Return "Accepted" if the frame is worth matching, otherwise the reason it was rejected.
+        roll and pitch are in radians as given by dronekit
+        """
+        result = self._check(frame, roll, pitch)
+        self.counts[result] += 1
+        return result
+
+    def _check(self, frame, roll, pitch):
+        if abs(roll) > self.max_tilt or abs(pitch) > self.max_tilt:
+            return "Attitude"
+
+        # Area averaging rather than skipping pixels, which would alias away the edges blur is judged by.
+        # A whole number shrink factor keeps it on OpenCV's fast path
+        factor = max(round(frame.shape[1] / self.width), 1)
+        height, width = frame.shape[0] // factor, frame.shape[1] // factor
+        small = cv2.resize(frame[:height * factor, :width * factor], (width, height), interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        brightness = small.mean()
+        clipped = ((small <= 5) | (small >= 250)).mean()
+        if not self.min_brightness <= brightness <= self.max_brightness or clipped > self.max_clipped:
+            return "Exposure"
+
+        # Compared with the recent frames, which are of much the same ground, before this one is added.
+        # Every frame goes in the history so a long run of blurred frames is eventually accepted
+        sharpness = cv2.meanStdDev(cv2.Laplacian(small, cv2.CV_32F))[1][0, 0] ** 2
+        typical = np.median(self.sharpness) if len(self.sharpness) >= 5 else 0
+        self.sharpness.append(sharpness)
+        if sharpness < max(self.min_sharpness * typical, self.sharpness_floor):
+            return "Blur"
+
+        return "Accepted"
+
+    def get_counts(self):
+        return dict(self.counts)
+
+    def reset(self):
+        """
+        Zero the counters and forget the sharpness of earlier frames e.g. at the start of a flight
+        """
+        self.counts = dict.fromkeys(GATE_RESULTS, 0)
+        self.sharpness.clear()
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    import os
+
+    gate = FrameGate()
+    directory = os.path.dirname(os.path.realpath(__file__)) + "/images/"
+    ground = cv2.imread(directory + "test_image_01.jpg", cv2.IMREAD_COLOR)
+
+    # Fill the sharpness history with sharp frames of the same ground as it would be in flight
+    for _ in range(10):
+        gate.check(ground)
+    print("Sharp, level: " + gate.check(ground))
+    print("Sharp, 15 degree roll: " + gate.check(ground, roll=math.radians(15)))
+    for length in 8, 15, 30, 60:
+        print(str(length) + " px motion blur: " + gate.check(cv2.blur(ground, (length, 1))))
+    print("Over exposed: " + gate.check(cv2.add(ground, 200)))
+    print(gate.get_counts())
+
+    # Blur is judged against the ground in view, not one fixed threshold for every scene
+    for i in range(1, 12):
+        ground = cv2.imread(directory + "test_image_" + str(i).zfill(2) + ".jpg", cv2.IMREAD_COLOR)
+        gate.reset()
+        results = [gate.check(ground) for _ in range(10)]
+        results += [gate.check(cv2.blur(ground, (length, 1))) for length in (8, 15, 30)]
+        print("test_image_" + str(i).zfill(2) + ": " + str(results[:10].count("Accepted")) + "/10 sharp accepted, "
+              + "8/15/30 px blur " + "/".join(results[10:]))
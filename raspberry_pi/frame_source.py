@@ -0,0 +1,228 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: frame_source.py
+# Description: Module to continuously capture frames in the background from a pluggable source
+
+import cv2
+import numpy as np
+import socket
+# Only the Raspberry Pi has a camera
+# Any other computer can still replay images or generate synthetic frames
+if socket.gethostname() == "raspberrypi":
+    from picamera.array import PiRGBArray
+    from picamera import PiCamera
+import threading
+import glob
+import time
+import os
+
+
+class PiCameraSource:
+    def __init__(self, resolution=(1296, 972), framerate=10):
+        """
+        Start the Raspberry Pi camera.
+        Frames are taken from the video port which is much faster than a still capture
+        """
+        self.resolution = resolution
+        self.camera = PiCamera(resolution=resolution, framerate=framerate)
+        self.raw_capture = PiRGBArray(self.camera, size=resolution)
+        self.stream = self.camera.capture_continuous(self.raw_capture, format="bgr", use_video_port=True)
+
+    def read(self, out):
+        """
+        Write the next frame into the array out
+        """
+        next(self.stream)
+        np.copyto(out, self.raw_capture.array)
+        self.raw_capture.truncate(0)
+        return True
+
+    def close(self):
+        self.stream.close()
+        self.camera.close()
+
+
+class DirectoryReplaySource:
+    def __init__(self, directory=None, pattern="test_image_*.jpg", resolution=None, framerate=10, loop=True):
+        """
+        Replay images from a directory as if they were coming from the camera.
+        All images are loaded once and resized to a single resolution
+        """
+        if directory is None:
+            directory = os.path.dirname(os.path.realpath(__file__)) + "/images"
+
+        paths = sorted(glob.glob(os.path.join(directory, pattern)))
+        if len(paths) == 0:
+            raise ValueError("No images matching " + pattern + " in " + directory)
+
+        images = [cv2.imread(path, cv2.IMREAD_COLOR) for path in paths]
+        if resolution is None:
+            resolution = (images[0].shape[1], images[0].shape[0])
+        self.resolution = resolution
+        self.images = [cv2.resize(image, resolution) for image in images]
+
+        self.period = 1 / framerate if framerate else 0
+        self.loop = loop
+        self.index = 0
+        self.last_read = 0
+
+    def read(self, out):
+        """
+        Write the next image into the array out.
+        Return False once every image has been replayed, unless looping
+        """
+        if self.index == len(self.images):
+            if not self.loop:
+                return False
+            self.index = 0
+
+        # Pace the replay at the requested frame rate
+        wait = self.last_read + self.period - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_read = time.perf_counter()
+
+        np.copyto(out, self.images[self.index])
+        self.index += 1
+        return True
+
+    def close(self):
+        pass
+
+
+class SyntheticSource:
+    def __init__(self, resolution=(1296, 972), framerate=10, pad_size=120, seed=0):
+        """
+        Generate frames of textured ground with the landing image drifting across them.
+        Useful for running the vision pipeline with no camera or test images
+        """
+        self.resolution = resolution
+        self.period = 1 / framerate if framerate else 0
+        self.last_read = 0
+        self.frame_count = 0
+
+        width, height = resolution
+        rng = np.random.default_rng(seed)
+        # Blur random noise so the background has texture without being pure noise to ORB
+        noise = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+        self.background = cv2.GaussianBlur(noise, (9, 9), 0)
+
+        target = cv2.imread(os.path.dirname(os.path.realpath(__file__)) + "/images/landing_image.png", cv2.IMREAD_COLOR)
+        self.pad = cv2.resize(target, (pad_size, pad_size))
+
+    def pad_position(self, frame_number):
+        """
+        Return the top left pixel of the pad in a given frame - the pad moves on a slow ellipse
+        """
+        width, height = self.resolution
+        size = self.pad.shape[0]
+        angle = frame_number * 0.05
+        x = int((width - size) / 2 * (1 + 0.8 * np.cos(angle)))
+        y = int((height - size) / 2 * (1 + 0.8 * np.sin(angle)))
+        return x, y
+
+    def read(self, out):
+        """
+        Write the next synthetic frame into the array out
+        """
+        wait = self.last_read + self.period - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_read = time.perf_counter()
+
+        np.copyto(out, self.background)
+        x, y = self.pad_position(self.frame_count)
+        size = self.pad.shape[0]
+        out[y:y + size, x:x + size] = self.pad
+        self.frame_count += 1
+        return True
+
+    def close(self):
+        pass
+
+
+class FrameGrabber:
+    def __init__(self, source, buffer_count=4, buffers=None, on_frame=None, held_index=None):
+        """
+        Capture frames from the source on a background thread.
+        Frames are written into a fixed ring of preallocated buffers so no memory
+        is allocated per frame. The newest frame is always available without waiting.
+        buffers can be given to capture straight into memory owned elsewhere e.g. shared memory.
+        on_frame(index, timestamp) is called after each capture and held_index() returns a slot
+        that is being read by someone else and must not be overwritten
+        """
+        self.source = source
+        width, height = source.resolution
+        if buffers is None:
+            buffers = np.empty((buffer_count, height, width, 3), dtype=np.uint8)
+        self.buffers = buffers
+        self.timestamps = np.zeros(len(buffers))
+        self.on_frame = on_frame
+        self.held_index = held_index
+
+        self.latest_index = -1
+        self.frame_count = 0
+        self.lock = threading.Lock()
+        self.new_frame = threading.Event()
+        self.is_running = False
+        self._thread = None
+
+    def _run(self):
+        while self.is_running:
+            # Write into the slot after the newest so the frame being read is not overwritten
+            index = (self.latest_index + 1) % len(self.buffers)
+            if self.held_index is not None and index == self.held_index():
+                index = (index + 1) % len(self.buffers)
+            if not self.source.read(self.buffers[index]):
+                break
+
+            with self.lock:
+                self.timestamps[index] = time.perf_counter()
+                self.latest_index = index
+                self.frame_count += 1
+            self.new_frame.set()
+            if self.on_frame is not None:
+                self.on_frame(index, self.timestamps[index])
+
+        self.is_running = False
+
+    def start(self):
+        if not self.is_running:
+            self.is_running = True
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def latest(self, wait=True, timeout=1):
+        """
+        Return the newest frame and the time it was captured.
+        Only waits if no frame has been captured yet.
+        The frame is a view into the ring so it stays valid for buffer_count - 1 more captures
+        """
+        if self.latest_index < 0 and wait:
+            self.new_frame.wait(timeout)
+
+        with self.lock:
+            if self.latest_index < 0:
+                return None, None
+            return self.buffers[self.latest_index], self.timestamps[self.latest_index]
+
+    def stop(self):
+        self.is_running = False
+        if self._thread is not None:
+            self._thread.join()
+        self.source.close()
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    for source in DirectoryReplaySource(framerate=20), SyntheticSource(framerate=20):
+        grabber = FrameGrabber(source)
+        grabber.start()
+        time.sleep(2)
+        frame, timestamp = grabber.latest()
+        grabber.stop()
+        print(type(source).__name__ + ": " + str(grabber.frame_count) + " frames of shape " + str(frame.shape)
+              + " in 2 s, newest is " + str(round((time.perf_counter() - timestamp) * 1000)) + " ms old")
@@ -5,6 +5,11 @@
 
 import serial
 from gpiozero import LED
+from telemetry import now, resync_clock
+from link_protocol import FrameReader, encode_frame, pack_telemetry, text_frames, TELEMETRY
+from collections import deque
+import threading
+import asyncio
 import time
 import os
 
@@ -23,6 +28,16 @@ class GroundControlStation:
         else:
             self.initSuccessful = False
 
+        # Once the reader thread is started messages are read as they arrive - see start_reader
+        self.reader = None
+        self.urgent = {}  # Message to handler(message, received) for messages that can't wait in the queue
+        self.loop = None  # Event loop to wake when a message arrives
+        self.messages = deque()
+        self._arrived = None
+        self.frames = FrameReader()
+        self.sequence = 0  # Of the frames sent
+        self._write_lock = threading.Lock()  # Messages are sent from several threads
+
         # Start handshake procedure
         handshake_complete = False
         print("Starting Handshake procedure with GCS")
@@ -32,7 +47,7 @@ class GroundControlStation:
         self.yellow_led.on()
 
         while not handshake_complete:
-            # Send an 'online' message every 0.5 seconds
+            # Send an 'online' message every 0.5 seconds, as a line as the GCS reads lines until the first frame
             self.ser.write("drone_online\n".encode('utf-8'))
             time.sleep(0.5)
 
@@ -54,7 +69,9 @@ class GroundControlStation:
                     self.send_message("Error updating time - please try again")
                     continue
                 else:
-                    # If time update was successful, let the GCS know and finish handshake
+                    # If time update was successful, let the GCS know and finish handshake.
+                    # Timestamps are only in the right epoch from now on
+                    resync_clock()
                     self.send_message("RPi time updated as: \"" + time_string + "\"")
                     print("RPi time updated as: \"" + time_string + "\"")
                     self.send_message("Handshake complete.")
@@ -68,7 +85,12 @@ class GroundControlStation:
             - whitespace
             - carriage return
             - new line
+        Never waits - returns None if there is no message
         """
+        if self.reader is not None:
+            # The reader thread is reading the port so take the oldest message it has received
+            return self.messages.popleft() if self.messages else None
+
         message_length = self.ser.in_waiting
 
         if message_length > 0:
@@ -81,19 +103,99 @@ class GroundControlStation:
 
         return message
 
+    def start_reader(self):
+        """
+        Read the port on a thread of its own from now on, so messages are picked up the moment they arrive.
+        Messages in urgent are passed straight to their handler from that thread with the time they were
+        received, the rest are kept for read_message and receive
+        """
+        if self.reader is None:
+            self.reader = threading.Thread(target=self._read, daemon=True)
+            self.reader.start()
+
+    async def receive(self):
+        """
+        Wait for the next message without polling. Use asyncio.wait_for for a timeout
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.start_reader()
+        while not self.messages:
+            self._arrived = self.loop.create_future()
+            await self._arrived
+        return self.messages.popleft()
+
+    def _wake(self):
+        # Runs on the event loop
+        if self._arrived is not None and not self._arrived.done():
+            self._arrived.set_result(None)
+
+    def _read(self):
+        """
+        Split whatever arrives into lines of text and frames, keeping any part of one until the rest arrives
+        """
+        while True:
+            try:
+                # Wakes as soon as a byte arrives, or after the port's timeout
+                data = self.ser.read(1)
+                if not data:
+                    continue
+                data += self.ser.read(self.ser.in_waiting)
+            except (OSError, TypeError, serial.SerialException):
+                return  # The port has been closed
+            received = now()
+
+            self.frames.feed(data)
+            item = self.frames.pop()
+            while item is not None:
+                frame_type, message = item
+                item = self.frames.pop()
+                if frame_type is not None:
+                    continue  # The GCS only sends text
+                if message in self.urgent:
+                    self.urgent[message](message, received)
+                else:
+                    self.messages.append(message)
+                    if self.loop is not None and not self.loop.is_closed():
+                        self.loop.call_soon_threadsafe(self._wake)
+
     def send_message(self, message):
         """
-        Send the message back to the GCS
+        Send the message back to the GCS.
+        Always sent in text frames so the GCS never reads part of a corrupt frame as a message
         """
         self.yellow_led.off()
         self.yellow_led.blink(on_time=0.05, off_time=0.05, n=6)  # Flash quick for 0.5 seconds when sending a message
-        self.ser.write((message + "\n").encode('utf-8'))
+        for frame_type, payload in text_frames(message):
+            self.send_frame(frame_type, payload)
+
+    def send_frame(self, frame_type, payload):
+        """
+        Send a binary frame - see link_protocol.py
+        """
+        with self._write_lock:
+            self.ser.write(encode_frame(frame_type, self.sequence, payload))
+            self.sequence += 1
+
+    def send_telemetry(self, state, sample):
+        """
+        Send the flight state and a Telemetry sample packed into a 26 byte frame,
+        rather than the 150 byte status line, so it can be sent several times a second
+        """
+        self.send_frame(TELEMETRY, pack_telemetry(state, sample))
+
+    def get_link_stats(self):
+        """
+        Return the number of lines and frames received, and the frames lost or corrupted
+        """
+        return dict(self.frames.stats)
 
     def close(self):
         """
         prepare for system shutdown
         stop processes, close communications and shutdown hardware where possible
         """
+        # The reader thread stops once the port is closed
         self.ser.close()
 
 
@@ -0,0 +1,181 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: instrumentation.py
+# Description: Low overhead latency histograms and per state counters for the control loop hot paths
+
+import functools
+import time
+
+# Latencies are counted in microseconds in HDR style buckets: exact below 64 us, then 32 buckets
+# for every doubling so every value is within about 3%. The memory used never grows
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_BITS = 26  # Latencies of 2^26 us, about 67 s, or more all count in the last bucket
+BUCKETS = (MAX_BITS - SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def bucket_index(microseconds):
+    exponent = max(microseconds.bit_length() - SUB_BUCKET_BITS - 1, 0)
+    return min(exponent * SUB_BUCKETS + (microseconds >> exponent), BUCKETS - 1)
+
+
+def bucket_range(index):
+    """
+    Return the lowest and highest latency in us counted in a bucket
+    """
+    exponent = max(index // SUB_BUCKETS - 1, 0)
+    lowest = (index - exponent * SUB_BUCKETS) << exponent
+    return lowest, lowest + (1 << exponent) - 1
+
+
+class LatencyHistogram:
+    def __init__(self, counts=None):
+        """
+        Fixed size histogram of latencies. counts can be any sequence of BUCKETS numbers to count into,
+        e.g. part of a shared memory array so another process can read the histogram
+        """
+        self.counts = [0] * BUCKETS if counts is None else counts
+
+    def record(self, microseconds):
+        self.counts[bucket_index(int(microseconds))] += 1
+
+    def percentile(self, percent, total=None):
+        """
+        Return the highest latency in us of the bucket holding the given percentile
+        """
+        if total is None:
+            total = sum(self.counts)
+        target = total * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return bucket_range(index)[1]
+        return 0
+
+    def snapshot(self):
+        """
+        Return the count then the mean, percentiles and maximum in ms
+        """
+        counts = [int(count) for count in self.counts]
+        total = sum(counts)
+        if total == 0:
+            return {"Count": 0}
+        used = [index for index, count in enumerate(counts) if count]
+        mean = sum(counts[index] * sum(bucket_range(index)) / 2 for index in used) / total
+        snapshot = {"Count": total, "Mean ms": round(mean / 1000, 3)}
+        for percent in PERCENTILES:
+            snapshot["P" + str(percent) + " ms"] = round(self.percentile(percent, total) / 1000, 3)
+        snapshot["Max ms"] = round(bucket_range(used[-1])[1] / 1000, 3)
+        return snapshot
+
+    def reset(self):
+        self.counts[:] = [0] * BUCKETS
+
+
+class Instrumentation:
+    def __init__(self):
+        """
+        Latency histograms of named code paths, plus how many times each path ran and any other
+        event happened in each state of the flight. Counting isn't locked: a count can very
+        rarely be lost when two threads record at once, which is the price of leaving it on in flight
+        """
+        self.histograms = {}
+        self.counters = {}
+        self.state = "Initial"
+        self.state_counts = self.counters.setdefault(self.state, {})
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = LatencyHistogram()
+        return self.histograms[name]
+
+    def add_histogram(self, name, histogram):
+        """
+        Include a histogram recorded elsewhere e.g. by the vision worker process
+        """
+        self.histograms[name] = histogram
+
+    def set_state(self, state):
+        self.state = state
+        self.state_counts = self.counters.setdefault(state, {})
+
+    def count(self, name):
+        """
+        Count an event in the current state
+        """
+        counts = self.state_counts
+        counts[name] = counts.get(name, 0) + 1
+
+    def timed(self, name):
+        """
+        Decorator to record how long every call of a function takes and count the calls in each state
+        """
+        histogram = self.histogram(name)
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter_ns()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    histogram.record((time.perf_counter_ns() - start) // 1000)
+                    counts = self.state_counts
+                    counts[name] = counts.get(name, 0) + 1
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """
+        Return the latency of every path that has run and the counts in each state, ready to send as JSON
+        """
+        latency = {name: histogram.snapshot() for name, histogram in list(self.histograms.items())}
+        return {"Latency": {name: stats for name, stats in latency.items() if stats["Count"]},
+                "Counts": {state: dict(counts) for state, counts in list(self.counters.items()) if counts}}
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.counters.clear()
+        self.set_state(self.state)
+
+
+# Shared by every module in the process
+INSTRUMENTS = Instrumentation()
+timed = INSTRUMENTS.timed
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    import random
+
+    # The bucket ranges must tile every latency with no gaps
+    for value in range(200000):
+        lowest, highest = bucket_range(bucket_index(value))
+        assert lowest <= value <= highest, value
+        assert highest - lowest <= max(value // SUB_BUCKETS, 0) + 1, value
+
+    @timed("empty")
+    def empty():
+        pass
+
+    def bare():
+        pass
+
+    # Overhead of timing a call
+    for function in bare, empty:
+        start = time.perf_counter()
+        for _ in range(100000):
+            function()
+        print(function.__name__ + ": {:.2f} us per call".format((time.perf_counter() - start) * 10))
+
+    INSTRUMENTS.set_state("Descending")
+    histogram = INSTRUMENTS.histogram("move_relative")
+    for _ in range(10000):
+        histogram.record(random.lognormvariate(7, 0.5))
+    print(INSTRUMENTS.snapshot())
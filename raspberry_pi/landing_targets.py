@@ -0,0 +1,180 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: landing_targets.py
+# Description: Module to hold the landing pad of every delivery location in one descriptor index
+
+import cv2
+import numpy as np
+from descriptor_bank import load_bank
+import os
+
+# OpenCV has no named constant for the LSH index in Python
+FLANN_INDEX_LSH = 6
+
+
+def read_pad_list(path=None):
+    """
+    Read the pad image of each location from a text file in the same format as locations.txt
+    e.g. "Post Room: images/landing_image.png". Relative paths are from this directory.
+    Return a list of (location, image path) in file order
+    """
+    directory = os.path.dirname(os.path.realpath(__file__))
+    if path is None:
+        path = directory + "/pads.txt"
+
+    pads = []
+    with open(path, 'r') as file:
+        for line in file.readlines():
+            if ":" not in line:
+                continue
+            name = line[:line.find(":")].strip()
+            image_path = line[line.find(":") + 1:].strip()
+            pads.append((name, os.path.join(directory, image_path)))
+    return pads
+
+
+class PadRegistry:
+    def __init__(self, pads=None):
+        """
+        Load the descriptor bank of every pad image and build one index over all of them.
+        pads is a list of (location, image path), by default read from pads.txt.
+        Locations that share an image share its descriptors so they never compete for votes
+        """
+        if pads is None:
+            pads = read_pad_list()
+        self.names = [name for name, _ in pads]
+
+        # Each distinct image is loaded once
+        self.images = []
+        self.image_of = []  # Index into self.images for each location
+        for _, image_path in pads:
+            paths = [image["path"] for image in self.images]
+            if image_path in paths:
+                self.image_of.append(paths.index(image_path))
+                continue
+            height, width = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE).shape
+            self.images.append({
+                "path": image_path,
+                "bank": load_bank(image_path),
+                "centre": np.array([[[width / 2, height / 2], [width / 2 + 1, height / 2]]], dtype=np.float32),
+            })
+            self.image_of.append(len(self.images) - 1)
+
+        # Locality sensitive hashing keeps a query close to constant time however many pads there are.
+        # Brute force is exact and is used instead once the pad is known.
+        # Both return arrays of indices and distances rather than a list of DMatch objects to unpack
+        self.index_params = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+        self.search_params = dict(checks=32)
+        self.index = None
+        self.build_index()
+
+        self.expected = None   # Image index of the pad to search for, None to identify it
+        self.expected_location = None
+        self._expected_descriptors = None
+        if len(self.images) == 1:
+            self.expect(self.names[0])
+
+    def build_index(self):
+        """
+        Put the descriptors of every image end to end, with the image each row came from, and index them.
+        Must be called again if self.images is changed
+        """
+        banks = [image["bank"] for image in self.images]
+        self.descriptors = np.ascontiguousarray(np.concatenate([bank["descriptor"] for bank in banks]))
+        self.points = np.ascontiguousarray(np.concatenate([bank["point"] for bank in banks]))
+        self.row_image = np.repeat(np.arange(len(banks), dtype=np.int32), [len(bank) for bank in banks])
+        self.row_start = np.concatenate(([0], np.cumsum([len(bank) for bank in banks])))
+
+        self.index = cv2.flann_Index(self.descriptors, self.index_params)
+
+    def expect(self, location):
+        """
+        Only search for the pad of this location, e.g. once the destination is set.
+        None goes back to identifying the pad from every location
+        """
+        if location is None:
+            self.expected = None
+            self.expected_location = None
+            self._expected_descriptors = None
+            return
+        image = self.image_of[self.names.index(location)]
+        # Copy the rows out of the memory mapped bank now rather than on the first frame
+        self._expected_descriptors = self.descriptors[self.row_start[image]:self.row_start[image + 1]].copy()
+        self.expected = image
+        self.expected_location = location
+
+    def get_location(self, image):
+        """
+        Return the location name for an image index returned by match.
+        The expected location is preferred when several locations share the image
+        """
+        if self.expected_location is not None and self.expected == image:
+            return self.expected_location
+        return self.names[self.image_of.index(image)]
+
+    def match(self, descriptors, max_distance):
+        """
+        Match query descriptors against the expected pad, or against every pad if none is expected.
+        Matches further than max_distance are dropped and the pad with the most matches wins.
+        Return the image index, the query indices and the row of each match in self.points
+        """
+        if self.expected is not None:
+            distances, train_idx = cv2.batchDistance(descriptors, self._expected_descriptors, cv2.CV_32S,
+                                                     normType=cv2.NORM_HAMMING, K=1)
+            train_idx = train_idx.ravel() + self.row_start[self.expected]
+        else:
+            train_idx, distances = self.index.knnSearch(descriptors, 1, params=self.search_params)
+            train_idx = train_idx.ravel()
+
+        # LSH may not find a neighbour for every query descriptor, marked with a negative index
+        good = np.flatnonzero((distances.ravel() <= max_distance) & (train_idx >= 0)).astype(np.int32)
+        query_idx = good
+        train_idx = train_idx[good]
+        if self.expected is not None:
+            return self.expected, query_idx, train_idx
+
+        # Vote for the pad
+        if len(good) == 0:
+            return None, query_idx, train_idx
+        row_image = self.row_image[train_idx]
+        image = int(np.argmax(np.bincount(row_image, minlength=len(self.images))))
+        same = row_image == image
+        return image, query_idx[same], train_idx[same]
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    from descriptor_bank import BANK_DTYPE
+    import time
+
+    directory = os.path.dirname(os.path.realpath(__file__)) + "/images/"
+    ground = cv2.imread(directory + "test_image_01.jpg", cv2.IMREAD_GRAYSCALE)
+    keypoints, query = cv2.ORB_create(300).detectAndCompute(ground, None)
+
+    # Pad the registry out with random pads to see how the query time grows with the number of pads
+    rng = np.random.default_rng(0)
+    registry = PadRegistry()
+    registry.expect(None)
+    real_pad = registry.images[0]
+    for pad_count in 1, 10, 100, 300:
+        while len(registry.images) < pad_count:
+            bank = np.zeros(len(real_pad["bank"]), dtype=BANK_DTYPE)
+            bank["descriptor"] = rng.integers(0, 256, bank["descriptor"].shape, dtype=np.uint8)
+            registry.images.append({"path": None, "bank": bank, "centre": real_pad["centre"]})
+        registry.build_index()
+
+        registry.match(query, 64)
+        start = time.perf_counter()
+        for _ in range(20):
+            image, query_idx, rows = registry.match(query, 64)
+        lsh_time = (time.perf_counter() - start) / 20
+
+        start = time.perf_counter()
+        cv2.batchDistance(query, registry.descriptors, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=1)
+        brute_time = time.perf_counter() - start
+
+        print("{} pads: LSH query {:.2f} ms found pad {} with {} matches, brute force {:.2f} ms".format(
+            pad_count, lsh_time * 1000, image, len(rows), brute_time * 1000))
@@ -5,44 +5,283 @@
 
 import cv2
 import numpy as np
-import socket
-# Only the Raspberry Pi can take pictures
-# Any other computer can still run the testbench
-if socket.gethostname() == "raspberrypi":
-    from picamera.array import PiRGBArray
-    from picamera import PiCamera
+from frame_source import FrameGrabber, SyntheticSource
+from landing_targets import PadRegistry
+import math
 import time
-import os
+
+# Field of view of the Raspberry Pi camera (v1) in degrees
+HORIZONTAL_FOV = 53.50
+VERTICAL_FOV = 41.41
 
 
 class LandingVision:
-    def __init__(self):
+    def __init__(self, frame_source=None, tracking=False, multi_scale=False, pads=None):
         """
         Initialise camera and class attributes
+        frame_source is any source from frame_source.py e.g. PiCameraSource.
+        If given, frames are captured continuously in the background.
+        If tracking is True, once the pad is found only a window around it is searched.
+        If multi_scale is True, the working resolution and ORB settings are chosen from the altitude.
+        pads is a list of (location, image path) to search for, by default every pad in pads.txt
         """
-        # Landing image to search for
-        print("Looking for image at path: " + os.path.dirname(os.path.realpath(__file__)) + "/images/landing_image.png")
-        self.target_image = cv2.imread(os.path.dirname(os.path.realpath(__file__)) + "/images/landing_image.png", cv2.IMREAD_COLOR)
-        self.target_image_grey = cv2.cvtColor(self.target_image, cv2.COLOR_BGR2GRAY)
-
         # Set up class attributes
         self.max_features = 100
-        self.good_match_percent = 0.1
-        if socket.gethostname() == "raspberrypi" and False:
-            self.camera = PiCamera()
+        self.max_match_distance = 64  # Hamming distance above which a match is ignored
+        self.min_good_matches = 10
+        self.min_inliers = 8
+        self.min_confidence = 0.3     # Fraction of good matches that must agree with the homography
+        self.ransac_threshold = 5.0   # Reprojection error in working resolution pixels
+        self.yaw = None               # Clockwise rotation of the pad in the image the last time it was found, radians
+        self.confidence = 0.0         # Confidence of the last pad position found
+        self.pad_found = False  # Whether the last call to get_offset found the pad
+        self.location = None    # Location whose pad was found last
+        self.frame_time = None  # perf_counter time the last camera frame was captured
+        self.grabber = None
+        if frame_source is not None:
+            self.grabber = FrameGrabber(frame_source)
+            self.grabber.start()
 
-        # Find the features of the landing zone image
         self.orb = cv2.ORB_create(self.max_features)
-        self.keypoints2, self.descriptors2 = self.orb.detectAndCompute(self.target_image_grey, None)
+
+        # Altitude bands each with their own working resolution and ORB settings.
+        # A width of None means the frame is processed at full resolution. Otherwise frames are shrunk by the
+        # smallest whole number factor that brings them within the band's width - 3, 2 and 1 for the camera.
+        # Low down the pad fills much of the frame so a small image finds it. High up it is only a few dozen pixels
+        # across so the camera resolution is kept. Every band uses half the default 8 pyramid levels: on the test
+        # images shrunk to the camera resolution, more features or a coarser pyramid found the pad no more often
+        # and were slower, and fewer features lost it
+        self.multi_scale = multi_scale
+        if multi_scale:
+            self.scale_levels = [self._build_level(10, 432, 100, 1.2, 4),
+                                 self._build_level(20, 648, 100, 1.2, 4),
+                                 self._build_level(math.inf, 1296, 100, 1.2, 4)]
+        else:
+            self.scale_levels = [{"max_altitude": math.inf, "width": None, "orb": self.orb}]
+        self.max_features = max(level["orb"].getMaxFeatures() for level in self.scale_levels)
+
+        # Features of every landing pad over several scales and rotations, cached on disk and held in one index
+        self.registry = PadRegistry(pads)
+        print("Looking for " + str(len(self.registry.images)) + " pad images for "
+              + str(len(self.registry.names)) + " locations")
+
+        # Buffers reused on every call so the hot path doesn't allocate
+        # ORB never returns more than max_features keypoints so these can be sized up front
+        self._src_points = np.empty((self.max_features, 2), dtype=np.float32)
+        self._dst_points = np.empty((self.max_features, 2), dtype=np.float32)
+        self._grey = None  # Sized on the first frame, reallocated only if the resolution changes
+
+        # Region of interest tracking
+        self.tracking = tracking
+        self.roi_min_half_size = 150    # Smallest half width of the search window in pixels
+        self.roi_altitude_gain = 10     # Extra pixels of half width per metre of altitude
+        self.roi_motion_gain = 2        # Multiple of the last frame to frame pad motion added to the window
+        self.last_centre = None         # Pixel position of the pad in the last frame it was found
+        self.last_motion = np.zeros(2)  # Pixel motion of the pad between the last two hits
+        self.tracking_stats = {}
+        self.reset_tracking_stats()
+
+    def _build_level(self, max_altitude, width, features, scale_factor, levels):
+        """
+        Create the ORB detector for one altitude band with its own feature count and image pyramid.
+        The descriptor bank already covers the range of sizes the pad appears at in every band
+        """
+        orb = cv2.ORB_create(features, scaleFactor=scale_factor, nlevels=levels)
+        return {"max_altitude": max_altitude, "width": width, "orb": orb}
+
+    def _select_level(self, altitude):
+        """
+        Return the scale level for the current altitude
+        """
+        for level in self.scale_levels:
+            if altitude <= level["max_altitude"]:
+                return level
+        return self.scale_levels[-1]
 
     def take_picture(self):
         """
-        Take a picture using the Raspberry Pi camera and return it as an image array
+        Return the newest frame from the background capture as an image array.
+        There is no wait unless the first frame hasn't arrived yet
+        """
+        frame, self.frame_time = self.grabber.latest()
+        return frame
+
+    def _to_grey(self, image):
+        """
+        Convert a BGR image to greyscale, writing into the reusable buffer
+        """
+        height, width = image.shape[:2]
+        if self._grey is None or self._grey.shape != (height, width):
+            self._grey = np.empty((height, width), dtype=np.uint8)
+        cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._grey)
+        return self._grey
+
+    def _locate(self, ground_grey, level=None, scale=1):
         """
-        raw_capture = PiRGBArray(self.camera)
-        time.sleep(0.1)  # Wait for 0.1 seconds for the camera to load
-        self.camera.capture(raw_capture, format="bgr")
-        return raw_capture.array
+        Find the landing image within a greyscale ground image.
+        The image is shrunk by scale before searching using the ORB settings of the level.
+        A RANSAC homography from the pad image to the ground gives the centre and yaw of the pad.
+        Return the centre in pixels of the original image, or None if it wasn't found with enough confidence
+        """
+        if level is None:
+            level = self.scale_levels[-1]
+        if scale < 1:
+            # Crop to a multiple of the whole number factor so INTER_AREA can take its much faster path
+            factor = round(1 / scale)
+            height, width = ground_grey.shape
+            ground_grey = cv2.resize(ground_grey[:height - height % factor, :width - width % factor], None,
+                                     fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        # Detect ORB features and compute descriptors
+        keypoints1, descriptors1 = level["orb"].detectAndCompute(ground_grey, None)
+        if descriptors1 is None:
+            return None
+
+        # Match features, identifying the pad unless the registry has been told which one to expect.
+        # Only good matches to a single pad are returned
+        image, query_idx, train_idx = self.registry.match(descriptors1, self.max_match_distance)
+        num_good_matches = len(query_idx)
+        if num_good_matches < self.min_good_matches:
+            return None
+
+        # Gather the matched points in the pad image and the ground image
+        src_points = self._src_points[:num_good_matches]
+        dst_points = self._dst_points[:num_good_matches]
+        np.take(self.registry.points, train_idx, axis=0, out=src_points)
+        np.take(cv2.KeyPoint_convert(keypoints1), query_idx, axis=0, out=dst_points)
+
+        homography, inlier_mask = cv2.findHomography(src_points, dst_points, cv2.RANSAC, self.ransac_threshold)
+        if homography is None:
+            return None
+        inliers = int(inlier_mask.sum())
+        confidence = inliers / num_good_matches
+        if inliers < self.min_inliers or confidence < self.min_confidence:
+            return None
+
+        # Project the centre of the pad, and a point just right of it to find the yaw
+        projected = cv2.perspectiveTransform(self.registry.images[image]["centre"], homography)[0]
+        direction = projected[1] - projected[0]
+        self.yaw = math.atan2(direction[1], direction[0])
+        self.confidence = confidence
+        self.location = self.registry.get_location(image)
+
+        return projected[0] / scale
+
+    def _roi(self, shape, altitude, scale=1):
+        """
+        Return the (x0, y0, x1, y1) window to search around the last pad position.
+        The window grows with altitude and with how fast the pad was moving in the image.
+        The fixed sizes are in working resolution pixels so are divided by the scale
+        """
+        height, width = shape[:2]
+        half_size = (self.roi_min_half_size + self.roi_altitude_gain * altitude) / scale \
+            + self.roi_motion_gain * np.abs(self.last_motion)
+
+        # Look where the pad is expected to be this frame rather than where it last was
+        centre = self.last_centre + self.last_motion
+        x0 = int(max(centre[0] - half_size[0], 0))
+        y0 = int(max(centre[1] - half_size[1], 0))
+        x1 = int(min(centre[0] + half_size[0], width))
+        y1 = int(min(centre[1] + half_size[1], height))
+        return x0, y0, x1, y1
+
+    def _search(self, ground_grey, altitude):
+        """
+        Locate the pad, searching only around its last position when tracking.
+        Fall back to a full frame search if the pad is lost
+        """
+        stats = self.tracking_stats
+        stats["Frames"] += 1
+        height, width = ground_grey.shape
+        centre = None
+        searched = 0
+
+        level = self._select_level(altitude)
+        scale = 1 / math.ceil(width / level["width"]) if level["width"] is not None else 1
+
+        if self.tracking and self.last_centre is not None:
+            x0, y0, x1, y1 = self._roi(ground_grey.shape, altitude, scale)
+            stats["ROI searches"] += 1
+            searched += (x1 - x0) * (y1 - y0)
+            if x1 - x0 > 0 and y1 - y0 > 0:
+                centre = self._locate(ground_grey[y0:y1, x0:x1], level, scale)
+            if centre is not None:
+                stats["ROI hits"] += 1
+                centre = centre + (x0, y0)
+
+        if centre is None:
+            stats["Full searches"] += 1
+            searched += height * width
+            centre = self._locate(ground_grey, level, scale)
+            if centre is not None:
+                stats["Full hits"] += 1
+
+        stats["Search area"] = searched / (height * width)
+        stats["Total search area"] += stats["Search area"]
+
+        # Update the track
+        if centre is None:
+            self.last_centre = None
+            self.last_motion = np.zeros(2)
+        else:
+            if self.last_centre is not None:
+                self.last_motion = centre - self.last_centre
+            self.last_centre = centre
+
+        return centre
+
+    def get_tracking_stats(self):
+        """
+        Return the tracking statistics along with the hit rates and mean fraction of the frame searched
+        """
+        stats = dict(self.tracking_stats)
+        stats["ROI hit rate"] = stats["ROI hits"] / stats["ROI searches"] if stats["ROI searches"] else 0
+        stats["Hit rate"] = (stats["ROI hits"] + stats["Full hits"]) / stats["Frames"] if stats["Frames"] else 0
+        stats["Mean search area"] = stats["Total search area"] / stats["Frames"] if stats["Frames"] else 0
+        return stats
+
+    def reset_tracking_stats(self):
+        """
+        Zero the tracking statistics e.g. at the start of a new flight
+        """
+        self.tracking_stats = {"Frames": 0,
+                               "ROI searches": 0,
+                               "ROI hits": 0,
+                               "Full searches": 0,
+                               "Full hits": 0,
+                               "Search area": 0.0,       # Fraction of the frame searched in the last frame
+                               "Total search area": 0.0  # Sum of the fraction searched over all frames
+                               }
+
+    def reset_tracking(self):
+        """
+        Forget the last pad position e.g. at the start of a new descent
+        """
+        self.last_centre = None
+        self.last_motion = np.zeros(2)
+
+    def expect_pad(self, location):
+        """
+        Only search for the pad of the given location, or every pad if location is None
+        """
+        self.registry.expect(location)
+        self.reset_tracking()
+
+    def _pixels_to_metres(self, centre, shape, altitude):
+        """
+        Convert a pixel position into a displacement in metres from the centre of the image.
+        Works at any resolution as the half width and height of the image map onto half the field of view
+        """
+        # Normalise the coordinates so that (0, 0) is the centre of the image and position of the drone
+        half_width = shape[1] / 2
+        half_height = shape[0] / 2
+        coords = [(centre[0] - half_width) / half_width, (half_height - centre[1]) / half_height]
+
+        # Convert into metres using the size of the ground in view
+        x_distance = round(coords[0] * altitude * math.tan(math.radians(HORIZONTAL_FOV / 2)), 2)
+        y_distance = round(coords[1] * altitude * math.tan(math.radians(VERTICAL_FOV / 2)), 2)
+
+        return x_distance, y_distance
 
     def get_offset(self, altitude, ground_in=None, test=None):
         """
@@ -53,53 +292,45 @@ class LandingVision:
         the drone being directly over the target.
         """
         if ground_in is None:
-            # Take a picture using the Pi Camera here
-            ground_grey = cv2.cvtColor(self.take_picture(), cv2.COLOR_BGR2GRAY)
-        else:
-            # Convert images to grayscale
-            ground_grey = cv2.cvtColor(ground_in, cv2.COLOR_BGR2GRAY)
-
-        # Detect ORB features and compute descriptors
-        keypoints1, descriptors1 = self.orb.detectAndCompute(ground_grey, None)
-
-        # Match features
-        matcher = cv2.DescriptorMatcher_create(cv2.DESCRIPTOR_MATCHER_BRUTEFORCE_HAMMING)
-        matches = matcher.match(descriptors1, self.descriptors2, None)
+            # Use the newest frame from the camera
+            ground_in = self.take_picture()
 
-        # Sort matches by score
-        matches.sort(key=lambda x: x.distance, reverse=False)
+        # Convert images to grayscale
+        ground_grey = self._to_grey(ground_in)
 
-        # Remove not so good matches
-        num_good_matches = int(len(matches) * self.good_match_percent)
-        matches = matches[:num_good_matches]
-
-        # Extract location of good matches
-        points1 = np.zeros((len(matches), 2), dtype=np.float32)
-
-        for i, match in enumerate(matches):
-            points1[i, :] = keypoints1[match.queryIdx].pt
-
-        if len(points1) < 10:
+        centre = self._search(ground_grey, altitude)
+        self.pad_found = centre is not None
+        if centre is None:
             print("No matching image found")
             return 0, 0  # If image can't be seen, descend vertically to get a closer look
-        else:
-            average = points1.mean(0, int)
 
         # Don't save any images under normal operation - only when running the testbench
         if test is not None:
-            mid = cv2.circle(ground, (average[0], average[1]), 100, (255, 0, 0), 50)
-            cv2.line(mid, (0, int(ground.shape[0] / 2)), (ground.shape[1], int(ground.shape[0] / 2)), (255, 255, 255), 10)
-            cv2.line(mid, (int(ground.shape[1] / 2), 0), (int(ground.shape[1] / 2), ground.shape[0]), (255, 255, 255), 10)
+            pixel = (int(centre[0]), int(centre[1]))
+            mid = cv2.circle(ground_in, pixel, 100, (255, 0, 0), 50)
+            cv2.line(mid, (0, int(ground_in.shape[0] / 2)), (ground_in.shape[1], int(ground_in.shape[0] / 2)), (255, 255, 255), 10)
+            cv2.line(mid, (int(ground_in.shape[1] / 2), 0), (int(ground_in.shape[1] / 2), ground_in.shape[0]), (255, 255, 255), 10)
             cv2.imwrite("images/located_" + test + ".jpg", mid)
 
-        # Normalise the coordinates so that (0, 0) is the centre of the image and position of the drone
-        coords = [int(average[0] - ground.shape[1] / 2), int(ground.shape[0] / 2 - average[1])]
+        return self._pixels_to_metres(centre, ground_grey.shape, altitude)
 
-        # Convert the pixels into metres
-        x_distance = round((coords[0] / 1296) * altitude * 0.51, 2)
-        y_distance = round((coords[1] / 972) * altitude * 0.37, 2)
+    def get_pose(self, altitude, ground_in=None):
+        """
+        As get_offset but also return the yaw of the pad and the confidence in the result.
+        Return (x, y, yaw, confidence), or None if the pad wasn't found
+        """
+        offset = self.get_offset(altitude, ground_in)
+        if not self.pad_found:
+            return None
+        return offset[0], offset[1], self.yaw, self.confidence
 
-        return x_distance, y_distance
+    def close(self):
+        """
+        prepare for system shutdown
+        stop the background capture if it is running
+        """
+        if self.grabber is not None:
+            self.grabber.stop()
 
 
 ########################################
@@ -109,10 +340,45 @@ class LandingVision:
 if __name__ == '__main__':
     vision = LandingVision()
 
+    grounds = []
     for i in range(1, 12):
         i = str(i).zfill(2)
         # Ground image to search within
         ground = cv2.imread("images/test_image_" + i + ".jpg", cv2.IMREAD_COLOR)
+        grounds.append(ground.copy())
 
         offset = vision.get_offset(30, ground, test=i)
         print(offset)
+
+    def time_per_frame(engine, altitude):
+        # Mean time to locate the pad in each test image
+        start = time.perf_counter()
+        for frame in grounds:
+            engine.get_offset(altitude, frame)
+        return (time.perf_counter() - start) / len(grounds)
+
+    # Time the hot path
+    print("Per frame latency: {:.1f} ms".format(time_per_frame(vision, 30) * 1000))
+
+    # Compare the full resolution and multi-scale modes across the altitude band
+    multi_scale_vision = LandingVision(multi_scale=True)
+    for altitude in 2, 5, 10, 20, 30:
+        times = []
+        found = []
+        for engine in vision, multi_scale_vision:
+            times.append(time_per_frame(engine, altitude))
+            found.append(sum(engine._search(engine._to_grey(frame), altitude) is not None for frame in grounds))
+        print("Altitude " + str(altitude) + " m: full {:.1f} ms, multi-scale {:.1f} ms, speedup {:.1f}x, "
+              "pad found in {} and {} of {} images".format(times[0] * 1000, times[1] * 1000, times[0] / times[1],
+                                                        found[0], found[1], len(grounds)))
+
+    # Run the full pipeline from a synthetic frame source as it would be in flight
+    for tracking in False, True:
+        vision.close()
+        vision = LandingVision(SyntheticSource(framerate=10), tracking=tracking)
+        start = time.perf_counter()
+        for _ in range(20):
+            vision.get_offset(30)
+        print("Tracking " + str(tracking) + ": " + str(round((time.perf_counter() - start) / 20 * 1000, 1))
+              + " ms per frame, " + str(vision.get_tracking_stats()))
+    vision.close()
@@ -0,0 +1,281 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: log_analysis.py
+# Description: Command line tool to split flight logs into phases and summarise each phase
+
+from flight_log import iter_records
+from multiprocessing import Pool
+import numpy as np
+import argparse
+import json
+import glob
+import re
+import os
+
+PHASES = ("Arming", "Ascent", "Traverse", "Descent", "Landing")
+
+# The phases are found from the height above the ground as a fraction of the flight's own peak height,
+# so the same thresholds suit 10 m missions and 3 m test hops. The barometer drifts by a metre or more
+# over a flight so the ground and peak are low and high percentiles of the whole flight's altitude
+GROUND_PERCENTILE = 5
+PEAK_PERCENTILE = 99
+ALTITUDE_BINS = np.arange(-100, 1000, 0.05)  # Fine enough for the percentiles and a fixed size however long the log
+MIN_PEAK_HEIGHT = 1.0    # Metres. A flight that never goes higher than this stays in Arming
+TAKEOFF_FRACTION = 0.6   # Above this the drone has taken off
+CRUISE_FRACTION = 0.8    # At or above this the drone is at traverse height
+DESCENT_FRACTION = 0.7   # Below this, after being at traverse height, the descent has started
+LANDING_FRACTION = 0.4   # Below this the drone is landing. The gaps between the fractions stop noise flipping phases
+SMOOTHING = 3.0          # Seconds of altitude averaged to take out barometer noise
+EARTH_RADIUS = 6371000
+
+# Phase each phase can go to next and the fraction of the peak height it is crossing, up or down.
+# A log can hold several hops so Landing goes back to Ascent
+TRANSITIONS = {0: ((1, TAKEOFF_FRACTION, "up"),),
+               1: ((2, CRUISE_FRACTION, "up"), (4, LANDING_FRACTION, "down")),
+               2: ((3, DESCENT_FRACTION, "down"),),
+               3: ((2, CRUISE_FRACTION, "up"), (4, LANDING_FRACTION, "down")),
+               4: ((1, TAKEOFF_FRACTION, "up"),)}
+
+
+def altitude_profile(paths, chunk_records=65536):
+    """
+    Stream every part of one flight and return its ground and peak altitude in metres
+    """
+    counts = np.zeros(len(ALTITUDE_BINS) - 1, dtype=np.int64)
+    for path in paths:
+        for records in iter_records(path, chunk_records):
+            counts += np.histogram(records["altitude"], ALTITUDE_BINS)[0]
+    if counts.sum() == 0:
+        return 0.0, 0.0
+    cumulative = np.cumsum(counts) / counts.sum()
+    ground = ALTITUDE_BINS[np.searchsorted(cumulative, GROUND_PERCENTILE / 100)]
+    peak = ALTITUDE_BINS[np.searchsorted(cumulative, PEAK_PERCENTILE / 100) + 1]
+    return float(ground), float(peak)
+
+
+class FlightAnalysis:
+    def __init__(self, ground, peak, nominal_interval=None):
+        """
+        Accumulate statistics for each phase of one flight from chunks of log records.
+        ground and peak are the altitudes from altitude_profile that the phase thresholds are fractions of.
+        Samples more than 1.5 nominal intervals apart are counted as late. If the nominal interval isn't
+        given it is taken as the median interval of the first chunk, as logs are recorded at 10 to 100 Hz.
+        Everything carried between chunks is kept on the object so a flight of any length can be streamed through
+        """
+        self.ground = ground
+        self.peak_height = peak - ground
+        self.nominal_interval = nominal_interval
+        self.window = None          # Samples of altitude averaged, set from the nominal interval
+        self.phase = 0
+        self.previous = None        # Last records of the previous chunk, enough to smooth the altitude across
+        self.totals = [{"Samples": 0, "Times entered": 0, "Duration (s)": 0.0, "Energy (Wh)": 0.0,
+                        "Distance (m)": 0.0, "GPS distance (m)": 0.0, "Speed samples": 0, "Speed sum": 0.0,
+                        "Speed sum sq": 0.0, "Max speed (m/s)": 0.0, "Max altitude (m)": -np.inf,
+                        "Interval sum sq": 0.0, "Max interval (s)": 0.0, "Late samples": 0} for _ in PHASES]
+
+    def _first(self, condition, start):
+        """
+        Index of the first True in condition at or after start, or the length of condition if there isn't one
+        """
+        found = np.flatnonzero(condition[start:])
+        return start + int(found[0]) if len(found) else len(condition)
+
+    def _smoothed_height(self, altitude):
+        """
+        Height above the ground as a fraction of the peak height, averaged over the last window samples
+        """
+        # NaN altitudes are logged before the flight controller has a position, when the drone is on the ground
+        height = np.nan_to_num((altitude - self.ground) / max(self.peak_height, MIN_PEAK_HEIGHT), nan=0.0)
+        total = np.cumsum(np.concatenate(([0.0], height)))
+        index = np.arange(1, len(height) + 1)
+        first = np.maximum(index - self.window, 0)
+        return (total[index] - total[first]) / (index - first)
+
+    def _segments(self, height, start):
+        """
+        Split the chunk from start into (phase, first record, end) runs, following TRANSITIONS from the
+        current phase. The phase the chunk ends in is left in self.phase
+        """
+        length = len(height)
+        if self.peak_height < MIN_PEAK_HEIGHT:
+            return [(self.phase, start, length)]
+
+        segments = []
+        while start < length:
+            end, following = length, None
+            for phase, fraction, direction in TRANSITIONS[self.phase]:
+                crossed = height >= fraction if direction == "up" else height < fraction
+                index = self._first(crossed, start)
+                if index < end:
+                    end, following = index, phase
+            segments.append((self.phase, start, end))
+            if following is None:
+                break
+            self.phase = following
+            self.totals[following]["Times entered"] += 1
+            start = end
+        return segments
+
+    def add(self, records):
+        """
+        Add the next chunk of records to the totals
+        """
+        if len(records) == 0:
+            return
+        skip = 0
+        if self.previous is not None:
+            skip = len(self.previous)
+            records = np.concatenate((self.previous, records))
+
+        timestamp = records["timestamp"]
+        altitude = records["altitude"].astype(np.float64)
+        groundspeed = records["groundspeed"].astype(np.float64)
+
+        # Each sample covers the interval since the one before. The first sample of the flight covers nothing
+        interval = np.diff(timestamp, prepend=timestamp[0])
+        if self.nominal_interval is None and len(interval) > 1:
+            self.nominal_interval = float(np.median(interval[1:]))
+        if self.window is None:
+            self.window = max(int(round(SMOOTHING / self.nominal_interval)), 1) if self.nominal_interval else 1
+        power = records["current"].astype(np.float64) * records["voltage"]
+        previous_power = np.concatenate((power[:1], power[:-1]))
+        energy = np.nan_to_num((power + previous_power) / 2 * interval)
+        distance = np.nan_to_num(groundspeed * interval)
+
+        # Equirectangular distance between fixes is plenty over 100 ms. No fix reads as 0 or NaN
+        latitude = np.radians(records["latitude"])
+        longitude = np.radians(records["longitude"])
+        d_lat = np.diff(latitude, prepend=latitude[0])
+        d_lon = np.diff(longitude, prepend=longitude[0]) * np.cos(latitude)
+        gps_distance = EARTH_RADIUS * np.hypot(d_lat, d_lon)
+        has_fix = (records["latitude"] != 0) & np.isfinite(gps_distance)
+        has_fix &= np.concatenate(([False], has_fix[:-1]))
+        gps_distance = np.where(has_fix, gps_distance, 0)
+
+        if self.previous is None:
+            self.totals[self.phase]["Times entered"] += 1
+
+        # The carried records were counted with the previous chunk
+        for phase, first, end in self._segments(self._smoothed_height(altitude), skip):
+            part = slice(first, end)
+            count = end - first
+            if count <= 0:
+                continue
+            totals = self.totals[phase]
+            speed = groundspeed[part][np.isfinite(groundspeed[part])]
+            totals["Samples"] += count
+            totals["Duration (s)"] += interval[part].sum()
+            totals["Energy (Wh)"] += energy[part].sum() / 3600
+            totals["Distance (m)"] += distance[part].sum()
+            totals["GPS distance (m)"] += gps_distance[part].sum()
+            totals["Speed samples"] += len(speed)
+            totals["Speed sum"] += speed.sum()
+            totals["Speed sum sq"] += (speed ** 2).sum()
+            if len(speed):
+                totals["Max speed (m/s)"] = max(totals["Max speed (m/s)"], speed.max())
+            totals["Max altitude (m)"] = max(totals["Max altitude (m)"], np.nanmax(altitude[part]))
+            totals["Interval sum sq"] += (interval[part] ** 2).sum()
+            totals["Max interval (s)"] = max(totals["Max interval (s)"], interval[part].max())
+            if self.nominal_interval is not None:
+                totals["Late samples"] += int((interval[part] > 1.5 * self.nominal_interval).sum())
+
+        self.previous = records[-self.window:].copy()
+
+    def summary(self):
+        """
+        Return the statistics of every phase that happened, rounded for display
+        """
+        summary = {}
+        for phase, totals in zip(PHASES, self.totals):
+            count = totals["Samples"]
+            if count == 0:
+                continue
+            speed_count = max(totals["Speed samples"], 1)
+            mean_speed = totals["Speed sum"] / speed_count
+            mean_interval = totals["Duration (s)"] / count
+            stats = {
+                "Samples": count,
+                "Times entered": totals["Times entered"],
+                "Duration (s)": totals["Duration (s)"],
+                "Energy (Wh)": totals["Energy (Wh)"],
+                "Distance (m)": totals["Distance (m)"],
+                "GPS distance (m)": totals["GPS distance (m)"],
+                "Mean speed (m/s)": mean_speed,
+                "Speed std (m/s)": np.sqrt(max(totals["Speed sum sq"] / speed_count - mean_speed ** 2, 0)),
+                "Max speed (m/s)": totals["Max speed (m/s)"],
+                "Max altitude (m)": totals["Max altitude (m)"],
+                "Mean interval (ms)": 1000 * mean_interval,
+                "Interval jitter (ms)": 1000 * np.sqrt(max(totals["Interval sum sq"] / count - mean_interval ** 2, 0)),
+                "Max interval (ms)": 1000 * totals["Max interval (s)"],
+                "Late samples": totals["Late samples"],
+            }
+            summary[phase] = {key: round(float(value), 3) if isinstance(value, float) else value
+                              for key, value in stats.items()}
+        return summary
+
+
+def analyse_flight(paths, chunk_records=65536):
+    """
+    Stream every part of one flight through a FlightAnalysis and return its summary.
+    The flight is read twice: first for its altitude profile, then for the phases
+    """
+    analysis = FlightAnalysis(*altitude_profile(paths, chunk_records))
+    for path in paths:
+        for records in iter_records(path, chunk_records):
+            analysis.add(records)
+    return analysis.summary()
+
+
+def group_flights(paths):
+    """
+    Group the parts of rotated logs, name_000.flog.gz, name_001.flog.gz..., into one flight each.
+    Directories are searched for logs. Return a dictionary of flight name to its paths in order
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in "*.csv", "*.flog", "*.flog.gz":
+                files.extend(glob.glob(os.path.join(path, pattern)))
+        else:
+            files.append(path)
+
+    flights = {}
+    for path in sorted(files):
+        name = re.sub(r"(_\d{3})?(\.flog(\.gz)?|\.csv)$", "", os.path.basename(path))
+        flights.setdefault(name, []).append(path)
+    return flights
+
+
+def _analyse(item):
+    name, paths = item
+    return name, analyse_flight(paths)
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Split flight logs into phases and summarise each phase")
+    parser.add_argument("logs", nargs="*", help="log files or directories (default: logging/)")
+    parser.add_argument("--workers", type=int, default=None, help="processes in the pool (default: all cores)")
+    parser.add_argument("--output", default=None, help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    if not args.logs:
+        args.logs = [os.path.dirname(os.path.realpath(__file__)) + "/logging"]
+    flights = group_flights(args.logs)
+
+    # Each flight is independent so analyse them in parallel
+    with Pool(args.workers) as pool:
+        results = dict(pool.map(_analyse, flights.items()))
+
+    for name, summary in results.items():
+        print(name)
+        for phase, stats in summary.items():
+            print("  " + phase.ljust(9) + "  ".join(key + ": " + str(value) for key, value in stats.items()))
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print("Results written to " + args.output)
@@ -0,0 +1,19 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: log_to_csv.py
+# Description: Command line tool to convert binary flight logs into the original CSV layout
+
+from flight_log import write_csv
+import argparse
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert binary flight logs (.flog) to CSV")
+    parser.add_argument("logs", nargs="+", help="binary log files to convert")
+    parser.add_argument("--output", default=None, help="CSV file to write (default: next to the log)")
+    args = parser.parse_args()
+
+    if args.output is not None and len(args.logs) > 1:
+        parser.error("--output can only be used with a single log")
+
+    for log in args.logs:
+        print(log + " -> " + write_csv(log, args.output))
@@ -0,0 +1,280 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: log_writer.py
+# Description: Module to write log data to files from a background thread so slow storage never stalls the caller
+
+from collections import deque
+import threading
+import struct
+import gzip
+import time
+import os
+
+
+class RotatingFile:
+    def __init__(self, base_path, suffix, header=b"", rotate_bytes=None, rotate_interval=None, index=False):
+        """
+        File like object that moves on to a new numbered part, base_path_000.suffix, base_path_001.suffix...
+        once the current part has rotate_bytes written to it or has been open for rotate_interval seconds.
+        Parts only change between writes so a write is never split, and every part starts with header.
+        If index is True, each part has a sidecar part.idx with an entry from write_indexed for every write
+        """
+        self.base_path = base_path
+        self.suffix = suffix
+        self.header = header
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        self.index = index
+        self.paths = []
+        self.file = None
+        self.index_file = None
+        self._open_next()
+
+    def _open_next(self):
+        if self.file is not None:
+            self.close()
+        self.paths.append(self.base_path + "_" + str(len(self.paths)).zfill(3) + self.suffix)
+        self.file = open(self.paths[-1], "wb")
+        self.file.write(self.header)
+        if self.index:
+            self.index_file = open(self.paths[-1] + ".idx", "wb")
+        self.part_bytes = len(self.header)
+        self.part_records = 0
+        self.part_started = time.perf_counter()
+
+    def _rotate_due(self, size):
+        if self.rotate_bytes is not None and self.part_bytes + size > self.rotate_bytes \
+                and self.part_bytes > len(self.header):
+            return True
+        return self.rotate_interval is not None and time.perf_counter() - self.part_started > self.rotate_interval
+
+    def write(self, data):
+        if self._rotate_due(len(data)):
+            self._open_next()
+        self.part_bytes += len(data)
+        return self.file.write(data)
+
+    def write_indexed(self, data, key, records):
+        """
+        Write data holding records records, the first of which has the timestamp key,
+        and add where it starts to the index
+        """
+        if self._rotate_due(len(data)):
+            self._open_next()
+        self.index_file.write(struct.pack("<dQQ", key, self.part_bytes, self.part_records))
+        self.part_records += records
+        self.part_bytes += len(data)
+        return self.file.write(data)
+
+    def write_trailer(self, data):
+        """
+        Write to the end of the current part, never starting a new one
+        """
+        self.part_bytes += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+        if self.index_file is not None:
+            self.index_file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+        if self.index_file is not None:
+            self.index_file.close()
+
+
+class LogSink:
+    def __init__(self, file, queue_size=1000, flush_bytes=4096, flush_interval=1.0, fsync_interval=None,
+                 compress_level=None, indexer=None):
+        """
+        Write blocks of bytes to an open binary file on a dedicated thread.
+        put() never blocks: blocks wait in a bounded queue and are dropped, and counted, if it is full.
+        Queued blocks are joined and written once flush_bytes have built up or flush_interval seconds have passed.
+        fsync_interval is the most seconds between forcing the data onto the storage.
+        0 syncs after every write and None leaves it to the operating system.
+        If compress_level is given, each write is compressed on the writer thread into its own gzip member.
+        The members of a file decompress as one stream but each can also be decoded alone,
+        so a crash only loses the member being written.
+        indexer(data) returns the timestamp of the first record in a write and the number of records in it.
+        If given, writes are passed to file.write_indexed so a RotatingFile can index them
+        """
+        self.file = file
+        self.queue_size = queue_size
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.compress_level = compress_level
+        self.indexer = indexer
+        self.trailer = None
+
+        # append and popleft on a deque are atomic so the caller and the writer thread never share a lock
+        self.queue = deque()
+        self.wake = threading.Event()
+        self.is_running = True
+
+        self.stats = {"Blocks": 0, "Dropped": 0, "Max queue depth": 0, "Writes": 0, "Bytes": 0, "Bytes written": 0,
+                      "Total write time": 0.0, "Max write time": 0.0, "Compress time": 0.0, "Syncs": 0, "Errors": 0}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, data):
+        """
+        Queue bytes to be written. Return False if the queue was full and they were dropped
+        """
+        depth = len(self.queue)
+        if depth >= self.queue_size:
+            self.stats["Dropped"] += 1
+            return False
+        self.queue.append(data)
+        self.stats["Blocks"] += 1
+        if depth + 1 > self.stats["Max queue depth"]:
+            self.stats["Max queue depth"] = depth + 1
+        if (depth + 1) * len(data) >= self.flush_bytes:
+            self.wake.set()
+        return True
+
+    def _run(self):
+        last_sync = time.perf_counter()
+        while self.is_running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            last_sync = self._write(last_sync)
+
+        # Write whatever is left before the file is closed, then the trailer as a write of its own
+        self._write(last_sync, final=True)
+        if self.trailer is not None:
+            trailer = self.trailer
+            if self.compress_level is not None:
+                trailer = gzip.compress(trailer, self.compress_level)
+            try:
+                # A trailer must end the last part rather than start a new one
+                if hasattr(self.file, "write_trailer"):
+                    self.file.write_trailer(trailer)
+                else:
+                    self.file.write(trailer)
+                self.file.flush()
+                if self.fsync_interval is not None:
+                    os.fsync(self.file.fileno())
+            except (OSError, ValueError):
+                self.stats["Errors"] += 1
+
+    def _write(self, last_sync, final=False):
+        """
+        Write every queued block in one go and sync if it is due. Return the time of the last sync
+        """
+        blocks = []
+        while self.queue:
+            blocks.append(self.queue.popleft())
+        if not blocks and not final:
+            return last_sync
+
+        data = b"".join(blocks)
+        self.stats["Bytes"] += len(data)
+        entry = self.indexer(data) if self.indexer is not None and data else None
+        if self.compress_level is not None and data:
+            start = time.perf_counter()
+            data = gzip.compress(data, self.compress_level)
+            self.stats["Compress time"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            if entry is not None:
+                self.file.write_indexed(data, *entry)
+            else:
+                self.file.write(data)
+            self.file.flush()
+            if self.fsync_interval is not None and (final or start - last_sync >= self.fsync_interval):
+                os.fsync(self.file.fileno())
+                last_sync = start
+                self.stats["Syncs"] += 1
+        except (OSError, ValueError):
+            # A pulled USB stick must not take the writer thread down with it
+            self.stats["Errors"] += 1
+        elapsed = time.perf_counter() - start
+
+        self.stats["Writes"] += 1
+        self.stats["Bytes written"] += len(data)
+        self.stats["Total write time"] += elapsed
+        self.stats["Max write time"] = max(self.stats["Max write time"], elapsed)
+        return last_sync
+
+    def get_stats(self):
+        """
+        Return the counters plus the current queue depth, the mean write latency in ms
+        and, if compressing, the compression ratio and the CPU time spent compressing in ms
+        """
+        stats = dict(self.stats)
+        stats["Queue depth"] = len(self.queue)
+        if self.compress_level is not None:
+            written = stats["Bytes written"]
+            stats["Compression ratio"] = round(stats["Bytes"] / written, 2) if written else 0
+            stats["Compress ms"] = round(1000 * stats["Compress time"], 2)
+        del stats["Compress time"]
+        mean = stats["Total write time"] / stats["Writes"] if stats["Writes"] else 0
+        stats["Mean write ms"] = round(1000 * mean, 2)
+        stats["Max write ms"] = round(1000 * stats.pop("Max write time"), 2)
+        del stats["Total write time"]
+        return stats
+
+    def close(self, trailer=None):
+        """
+        Write everything still queued followed by the trailer bytes if given, sync if asked to, and close the file
+        """
+        self.trailer = trailer
+        self.is_running = False
+        self.wake.set()
+        self._thread.join()
+        try:
+            self.file.close()
+        except OSError:
+            self.stats["Errors"] += 1
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    import tempfile
+
+    class SlowFile:
+        # Stand in for a USB stick that stalls for a second on every write
+        def __init__(self, file):
+            self.file = file
+
+        def write(self, data):
+            time.sleep(1)
+            return self.file.write(data)
+
+        def flush(self):
+            self.file.flush()
+
+        def fileno(self):
+            return self.file.fileno()
+
+        def close(self):
+            self.file.close()
+
+    directory = tempfile.mkdtemp()
+    fast = LogSink(open(directory + "/fast.bin", "wb"), fsync_interval=1.0)
+    slow = LogSink(SlowFile(open(directory + "/slow.bin", "wb")), queue_size=8)
+
+    # Log 56 byte records at 10 Hz for 3 s and time how long the caller spends in put()
+    record = bytes(56)
+    worst = 0
+    for _ in range(30):
+        start = time.perf_counter()
+        fast.put(record)
+        slow.put(record)
+        worst = max(worst, time.perf_counter() - start)
+        time.sleep(0.1)
+
+    fast.close()
+    slow.close()
+    print("Worst time in put: {:.3f} ms".format(worst * 1000))
+    print("Fast sink: " + str(fast.get_stats()))
+    print("Slow sink: " + str(slow.get_stats()))
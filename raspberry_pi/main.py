@@ -7,9 +7,16 @@ from flight_controller import FlightController
 from ground_communication import GroundControlStation
 from micro_controller import MicroController
 from data_logging import DataLogging
-from landing_vision_2 import LandingVision
-from recurring_timer import RecurringTimer
-
+from vision_worker import VisionWorker
+from frame_source import PiCameraSource
+from state_estimator import PadEstimator
+from scheduler import Scheduler, COALESCE
+from instrumentation import INSTRUMENTS, timed
+from safety import SafetyExecutor
+
+import threading
+import asyncio
+import math
 import sys
 import json
 import time
@@ -31,7 +38,13 @@ class DroneControl:
         # dictionary of flight parameters
         self.parameters = {
             "descent_vel": 0.25,
-            "logging_interval": 0.1
+            "logging_interval": 0.1,
+            "reporting_interval": 0.2,  # Telemetry frames to the GCS at 5 Hz - see link_protocol.py
+            "message_interval": 0.1,
+            "safety_deadline": 0.1,  # Most seconds from receiving a safety command to acting on it
+            "logging_rate": 50,  # Hz, in a scheduler job of its own. None to log from the monitoring tick instead
+            "guidance_interval": 0.05,  # Control loop runs at 20 Hz during descent
+            "p_gain": 0.1  # Halved when offsets were corrected to the camera field of view, which doubled them
         }
 
         # Pulse the green LED constantly while script is running
@@ -69,16 +82,68 @@ class DroneControl:
             raise ValueError("Failed to communicate with Micro Controller")
         
         self.logger = DataLogging()
-        self.vision = LandingVision()
-        self.scheduler = RecurringTimer(self.parameters["logging_interval"], self.__monitor_flight)
+
+        try:
+            # Vision runs in its own process so it doesn't stall logging and serial polling
+            self.vision = VisionWorker(PiCameraSource(), {"tracking": True, "multi_scale": True})
+        except:
+            self.vision = None
+            self.report("Camera failed")
+            # Only a mission lands on a pad, the other test modes carry on without the camera
+            if test == "mission":
+                raise ValueError("Failed to start the camera")
+        else:
+            self.report("Camera started")
+            # Only search for the destination's own pad once it is known
+            self.fc.destination_listeners.append(self.vision.expect_pad)
+            # Each frame is tagged with the attitude and altitude it was captured at, so keep them as fresh
+            # as the MAVLink stream rather than the guidance rate
+            self.fc.subscribers.append(self.__update_vision)
+            INSTRUMENTS.add_histogram("get_offset", self.vision.latency)
+        self.estimator = PadEstimator()
+
+        # Safety commands are passed from the GCS reader thread straight to a thread of their own
+        # so nothing else can hold them up - see safety.py
+        self.safety = SafetyExecutor()
+        deadline = self.parameters["safety_deadline"]
+        for command, action, priority in ("emergency land", self.__emergency_land, 0), ("abort", self.__abort, 1):
+            registered = self.safety.register(command, action, priority, deadline)
+            INSTRUMENTS.add_histogram(command + " reaction", registered.reaction)
+            self.gcs.urgent[command] = self.__safety_command
+        # Held while a safety action changes the mode, and while a flight step checks for one before sending
+        # its own command, so a step can never override a safety command sent just before it
+        self.command_lock = threading.Lock()
+
+        # Every periodic job - guidance, logging and reporting - shares this one thread.
+        # Lower priority numbers run first when jobs are due together
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.descended = None  # Future the guidance job completes on reaching 2 m
+        self.flying = False  # Safety commands are only acted on from arming until the drone has landed
+        self.flight_ended = None  # Event a safety command sets to stop execute_flight waiting - see unless_ended
+        self.loop = None
+        self.last_sequence = 0
 
         # Setting up class attributes
         self.abortFlag = None
         self.emergency_land = False
+        self.guidance_timing = {}
         self.state = "Initial"
         self.received_mission = None
         self.mission_title = "Default mission name"
-        self.reporting_count = 0
+
+        # Only start reading the GCS once everything the safety actions use is set up
+        self.gcs.start_reader()
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        # Events are counted against the state they happen in
+        self._state = state
+        INSTRUMENTS.set_state(state)
 
     def alert_initialisation_failure(self):
         """
@@ -94,6 +159,17 @@ class DroneControl:
         self.gcs.send_message(message)
         print(message)
 
+    def report_instrumentation(self):
+        """
+        Send the latency of each instrumented path and the counts in each state to the GCS, one line each.
+        Sent whenever the GCS sends "stats"
+        """
+        snapshot = INSTRUMENTS.snapshot()
+        for name, stats in snapshot["Latency"].items():
+            self.report(name + ": " + json.dumps(stats))
+        for state, counts in snapshot["Counts"].items():
+            self.report(state + ": " + json.dumps(counts))
+
     def abort(self):
         """
         called at any time and will reset drone so in idle state
@@ -103,7 +179,7 @@ class DroneControl:
         self.abortFlag = True
         self.report("Mission abort successful.")
 
-    def wait_for_command(self):
+    async def wait_for_command(self):
         """
         drone is in idle state waiting for a command
         return: 0 - shutdown
@@ -116,30 +192,36 @@ class DroneControl:
 
         command = -1
         while command == -1:
-            # msg will be type None if no message to read
-            msg = self.gcs.read_message()
+            # Sleeps until a message arrives
+            msg = await self.gcs.receive()
 
             if msg == "shutdown":
                 command = 0
             elif msg == "reboot":
                 command = 2
+            elif msg == "stats":
+                self.report_instrumentation()
             elif msg == "mission":
                 # mission command recieved, waiting for mission details.
-                start = time.perf_counter()
-
-                # timeout after 5 sec
-                while time.perf_counter() - start < 5:
-                    mission_message = self.gcs.read_message()
-                    if mission_message is not None:
-                        self.received_mission = json.loads(mission_message)
-                        command = 1
-                        break
-                else:
+                try:
+                    # timeout after 5 sec
+                    mission_message = await asyncio.wait_for(self.gcs.receive(), 5)
+                except asyncio.TimeoutError:
                     self.report("Wait for mission details timed out after 5 seconds")
                     self.abort()
+                else:
+                    self.received_mission = json.loads(mission_message)
+                    command = 1
 
         return command
 
+    async def wait_for_message(self, expected):
+        """
+        Wait until the expected message is received from the GCS, ignoring any others
+        """
+        while await self.gcs.receive() != expected:
+            pass
+
     def process_mission(self):
         """
         Processes the received mission and set class attributes
@@ -154,42 +236,40 @@ class DroneControl:
         else:
             self.report("Mission processing finished.")
 
-    def battery_load(self):
+    async def battery_load(self):
         """
-        loops until battery is loaded
-        poll FC to determine if loaded
-        timeout after 30 s
+        waits until battery is loaded
+        the FC battery updates are checked to determine if loaded
+        timeout after 20 s for each step
         """
         self.report("Waiting for battery to be loaded.")
 
         # wait for battery connection
-        start = time.perf_counter()
-        while time.perf_counter() - start < 20:
-            if self.fc.is_battery_connected():
-                self.report("Battery connected.")
-                break
-        else:
+        try:
+            await asyncio.wait_for(self.fc.wait_until(self.fc.is_battery_connected, "battery"), 20)
+        except asyncio.TimeoutError:
             self.report("Battery not connected within 20 seconds.")
+        else:
+            self.report("Battery connected.")
 
         # wait for battery secured confirmation
-        start = time.perf_counter()
-        while time.perf_counter() - start < 20:
-            if self.gcs.read_message() == "battery secured":
-                self.report("Battery loaded.")
-                break
-        else:
+        try:
+            await asyncio.wait_for(self.wait_for_message("battery secured"), 20)
+        except asyncio.TimeoutError:
             self.report("Battery secured confirmation not received within 20 seconds.")
+        else:
+            self.report("Battery loaded.")
 
-    def parcel_load(self):
+    async def parcel_load(self):
         """
         Waits for button press to start parcel load
         """
         # Wait for the button to be pressed
-        self.button.wait_for_press()
+        await wait_for_press(self.button)
 
-        # This function is blocking
+        # This function is blocking so it runs on a worker thread
         self.report("Closing grippers")
-        self.uC.close_grippers()
+        await asyncio.get_running_loop().run_in_executor(None, self.uC.close_grippers)
 
         if self.uC.is_parcel_loaded():
             self.report("Parcel loaded.")
@@ -208,7 +288,7 @@ class DroneControl:
             self.report("Arming check failed.")
             self.abort()
 
-    def wait_for_flight_authorisation(self):
+    async def wait_for_flight_authorisation(self):
         """
         wait for authorisation from ground control station to begin flight
         timeout after 30 s
@@ -217,111 +297,289 @@ class DroneControl:
         self.report("Reply \"takeoff\"")
 
         # wait for message authorising flight - timeout 30 s
-        timeout = 30
-        start = time.perf_counter()
-        while time.perf_counter() - start < timeout:
-            if self.gcs.read_message() == "takeoff":
-                self.report("Authorisation received.")
-                break
-        else:
+        try:
+            await asyncio.wait_for(self.wait_for_message("takeoff"), 30)
+        except asyncio.TimeoutError:
             self.report("Authorisation window timed out.")
             self.abort()
+        else:
+            self.report("Authorisation received.")
 
-    def execute_flight(self):
+    async def execute_flight(self):
         """
         monitor drone status
         facilitate logging
         report to base
         continue when loiter point reached
+        Returns False if a safety command ended the flight early, once the drone has landed
         """
         # Start data logging
-        self.logger.prepare_for_logging(self.mission_title)
-        self.scheduler.start()
+        self.start_logging(self.mission_title)
+        self.vision.reset_stats()
+
+        # From here until the drone has landed a safety command can end the flight
+        self.loop = asyncio.get_running_loop()
+        self.flight_ended = asyncio.Event()
+        self.flying = True
 
         self.report("Drone is arming and taking off...")
         self.state = "Arming"
-        self.fc.arm()
+        # This function is blocking so it runs on a worker thread
+        await self.loop.run_in_executor(None, self.fc.arm)
 
-        # Loop until the drone is almost at traverse altitude
+        # Each step only goes ahead if no safety command has ended the flight
+        # Wait until the drone is almost at traverse altitude
         self.state = "Ascending"
-        self.fc.start_ascending()
-        while self.fc.get_altitude() < self.fc.mission_height * 0.95:
-            time.sleep(0.1)
-
-        # Loop until the drone is within 5m of destination
-        self.fc.fly_to_destination()
-        self.state = "Traversing"
-        while self.fc.get_distance_left() > 5:
-            time.sleep(0.1)
-
-        # Loop until the drone is within 2m of ground
-        self.fc.change_flight_mode("AUTO")
-        self.state = "Descending"
-        current_alt = self.fc.get_altitude()
-        while current_alt > 2:
-            # Use vision system for guidance
-            x_vel, y_vel = 1, 2  # self.vision.get_offset(current_alt)
-            z_vel = self.parameters["descent_vel"]
-            p_gain = 0.2
-            self.fc.move_relative(p_gain * x_vel, p_gain * y_vel, z_vel, 0)
-            # Add a delay so that the drone isn't at an angle when the picture is taken
-            time.sleep(1)
-            current_alt = self.fc.get_altitude()
-
-        # Loop until the drone has landed and is disarmed
-        self.state = "Landing"
-        self.fc.land()  # This is non blocking
+        completed = self.__command(self.fc.start_ascending) and await self.unless_ended(
+            self.fc.wait_until(lambda: self.fc.get_altitude() >= self.fc.mission_height * 0.95, "position"))
+
+        # Wait until the drone is within 5m of destination
+        if completed:
+            self.state = "Traversing"
+            completed = self.__command(self.fc.fly_to_destination) and await self.unless_ended(
+                self.fc.wait_until(lambda: self.fc.get_distance_left() <= 5, "position"))
+
+        # Wait until the drone is within 2m of ground
+        if completed:
+            self.state = "Descending"
+            completed = self.__command(self.fc.change_flight_mode, "AUTO") and await self.descend_to_pad()
+
+        # Wait until the drone has landed and is disarmed
+        if completed:
+            self.state = "Landing"
+            completed = self.__command(self.fc.land)  # This is non blocking
         while self.fc.vehicle.armed:
-            drone.report("Drone is landing")
-            time.sleep(1)
+            if completed:
+                self.report("Drone is landing")
+            elif self.emergency_land:
+                self.report("Drone is executing emergency landing.")
+            else:
+                self.report("Flight aborted, waiting for the pilot to land the drone.")
+            await asyncio.sleep(1)
+        self.flying = False
+        self.loop = None
 
-        drone.report("Drone landed.")
+        self.report("Drone landed.")
+        self.report("Vision frames: " + str(self.vision.get_gate_stats()))
+        self.report("Vision tracking: " + str(self.vision.get_tracking_stats()))
 
         # Stop data logging
-        self.scheduler.stop()
-        self.logger.finish_logging()
+        self.stop_logging()
+        self.report("Logging: " + str(self.logger.get_stats()))
+        self.report("Logging timing: " + str(self.logger.get_timing()))
+        self.report("Guidance timing: " + str(self.guidance_timing))
+        self.report("Safety: " + str(self.safety.get_stats()))
+        self.report("GCS link: " + str(self.gcs.get_link_stats()))
+
+        if self.emergency_land:
+            self.report("Drone has finished emergency landing.")
+            # Then exit the script so operator can approach and turn off the drone
+            self.__prepare_exit()
+        return completed
+
+    async def unless_ended(self, awaitable):
+        """
+        Wait for a step of the flight unless a safety command ends the flight first, in which case the step
+        is cancelled. Returns True if the step finished
+        """
+        step = asyncio.ensure_future(awaitable)
+        ended = asyncio.ensure_future(self.flight_ended.wait())
+        await asyncio.wait((step, ended), return_when=asyncio.FIRST_COMPLETED)
+        ended.cancel()
+        if not step.done():
+            step.cancel()
+            return False
+        step.result()  # Raise anything the step raised
+        return True
+
+    def __command(self, action, *args):
+        """
+        Send a command to the flight controller unless a safety command has ended the flight.
+        Returns True if it was sent
+        """
+        with self.command_lock:
+            if self.emergency_land or self.abortFlag:
+                return False
+            action(*args)
+            return True
+
+    def start_logging(self, name):
+        """
+        Open the log files and add the monitoring jobs to the scheduler.
+        At a high logging rate the logger reads the telemetry itself in a job of its own
+        """
+        # Each log's trailer holds the instrumentation of just that flight
+        INSTRUMENTS.reset()
+        self.logger.prepare_for_logging(name)
+        if self.parameters["logging_rate"] is not None:
+            self.logger.start_recording(self.scheduler, self.fc.get_state, self.parameters["logging_rate"])
+        self.scheduler.add("messages", self.parameters["message_interval"], self.__handle_messages, priority=0)
+        self.scheduler.add("monitor", self.parameters["logging_interval"], self.__monitor_flight, priority=2)
+        self.scheduler.add("report", self.parameters["reporting_interval"], self.__report_status, priority=3)
+
+    def stop_logging(self):
+        # Waits for any run that has already started to finish
+        for name in "messages", "monitor", "report":
+            self.scheduler.remove(name)
+        self.logger.finish_logging(instrumentation=INSTRUMENTS.snapshot())
+
+    async def descend_to_pad(self):
+        """
+        Steer onto the landing pad while descending to 2 m. Returns False if a safety command ended the descent.
+        The vision worker processes frames as fast as it can and the estimator fuses each new result
+        with the drone's velocity so that guidance commands can be sent every guidance_interval
+        """
+        self.estimator.reset()
+        self.vision.reset_tracking()
+        self.last_sequence = 0
+        loop = asyncio.get_running_loop()
+        self.descended = loop.create_future()
+
+        # A late guidance tick sends one command from fresh data rather than a burst of stale ones
+        self.scheduler.add("guidance", self.parameters["guidance_interval"], self.__guide, loop,
+                           priority=1, policy=COALESCE)
+        try:
+            if not await self.unless_ended(self.descended):
+                return False
+            self.guidance_timing = self.descended.result()
+            return True
+        finally:
+            # A safety command ended the descent - waits for a guidance tick that has already started
+            job = self.scheduler.remove("guidance")
+            if job is not None:
+                self.guidance_timing = job.get_stats()
+
+    @timed("guidance")
+    def __guide(self, loop):
+        """
+        One guidance tick of descend_to_pad. Ends the descent with the guidance timing once down to 2 m
+        """
+        # A safety command has taken over
+        if self.emergency_land or self.abortFlag:
+            return
+
+        # Shares the vehicle read with any other job in the same tick
+        sample = self.fc.get_state()
+        if sample.alt <= 2:
+            job = self.scheduler.remove("guidance")
+            loop.call_soon_threadsafe(self.__descent_finished, job.get_stats())
+            return
+
+        now = time.perf_counter()
+        velocity_x, velocity_y = sample.velocity_body()
+        self.estimator.predict(velocity_x, velocity_y, now)
+
+        # Never waits - only fuse a result if the worker has produced a new one.
+        # The tilt is compensated with the attitude the frame was captured at, not the current one
+        result = self.vision.latest_result()
+        if result is not None and result["sequence"] != self.last_sequence:
+            self.last_sequence = result["sequence"]
+            if result["found"]:
+                self.estimator.update_vision(result["x"], result["y"], result["frame_time"],
+                                             result["altitude"], result["roll"], result["pitch"])
+
+        # If the pad hasn't been seen, descend vertically to get a closer look
+        estimate = self.estimator.get_estimate()
+        x_vel, y_vel = (0, 0) if estimate is None else estimate[:2]
+
+        # Body frame velocities are forwards then right. Not sent if a safety command arrived during the tick
+        p_gain = self.parameters["p_gain"]
+        if not self.__command(self.fc.move_relative, p_gain * y_vel, p_gain * x_vel, self.parameters["descent_vel"], 0):
+            return
+
+        # Time from the position arriving over MAVLink to the command it led to
+        age = sample.age("position")
+        if not math.isnan(age):
+            INSTRUMENTS.histogram("position_to_command").record(age * 1e6)
+
+    def __descent_finished(self, timing):
+        # Run on the event loop. A safety command may already have cancelled the descent
+        if not self.descended.done():
+            self.descended.set_result(timing)
+
+    def __update_vision(self, group, state):
+        """
+        FlightController subscriber, called from dronekit's thread whenever a group of the vehicle state changes
+        """
+        if group == "attitude":
+            self.vision.set_attitude(state.roll, state.pitch)
+        elif group == "position":
+            self.vision.set_altitude(state.alt)
+
+    def __handle_messages(self):
+        """
+        Answer a request for the instrumentation from the GCS. Safety commands never reach here
+        """
+        if self.gcs.read_message() == "stats":
+            self.report_instrumentation()
+
+    def __safety_command(self, command, received):
+        """
+        GCS urgent handler, called from the GCS reader thread. Safety commands are only acted on while
+        the drone is flying or armed - there is nothing to land or abort otherwise
+        """
+        if self.flying or self.fc.vehicle.armed:
+            self.safety.trigger(command, received)
+        else:
+            self.report("Ignored " + command + " as the drone is not flying.")
 
-    def __monitor_flight(self):
+    def __emergency_land(self):
         """
-        Get flight data from various places and send them to the data logging module
+        Safety action, run on the safety thread: only sends the mode change so it returns within the deadline.
+        execute_flight follows the landing
         """
-
-        if self.gcs.read_message() == "emergency land":
+        with self.command_lock:
             self.fc.vehicle.mode = "LAND"
-            while self.fc.vehicle.armed:
-                self.report("Drone is executing emergency landing.")
-                time.sleep(1)
-            self.report("Drone has finished emergency landing.")
+            self.emergency_land = True
+        self.__end_flight()
 
-            # Then exit the script so operator can approach and turn off the drone
-            self.__prepare_exit()
+    def __abort(self):
+        """
+        Safety action, run on the safety thread: stop guiding the drone and hold position for the pilot.
+        The drone goes back to idle once it has landed
+        """
+        with self.command_lock:
+            if self.fc.vehicle.armed:
+                self.fc.vehicle.mode = "LOITER"
+            self.abortFlag = True
+        self.__end_flight()
 
-        # Get details to log
-        fc_stats = self.fc.get_fc_stats()
-        current = self.fc.vehicle.battery.current  # self.uC.get_current() for SITL
+    def __end_flight(self):
+        # Stop guiding straight away - waits for a tick that has already started, which sends nothing now
+        job = self.scheduler.remove("guidance")
+        if job is not None:
+            self.guidance_timing = job.get_stats()
 
-        # Send the details to the data logging module
-        self.logger.log_info(current, fc_stats)
+        # Stop execute_flight waiting on the current step. Not set outside a flight e.g. the take off test
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.flight_ended.set)
 
-        # Every second, report the flight stats to the GCS
-        if self.reporting_count % 10 == 0:
-            message = "State: " + self.state.ljust(10) \
-                      + "  |  Altitude: " + fc_stats["Location alt"].ljust(6) \
-                      + "  |  Remaining Distance: " + str(round(float(fc_stats["Distance to waypoint"]))).ljust(4) \
-                      + "  |  Speed: " + str(round(float(fc_stats["Groundspeed"]), 2)).ljust(5) \
-                      + "  |  Battery Voltage (V): " + fc_stats["Battery"].ljust(5) \
-                      + "  |  Battery Current (A): " + str(round(float(current))).ljust(5)
+    @timed("monitor_flight")
+    def __monitor_flight(self):
+        """
+        Get flight data from various places and send them to the data logging module
+        """
+        # The flight controller reads the vehicle once per tick however many jobs ask
+        state = self.fc.get_state()
 
-            self.report(message)
+        # Send the details to the data logging module, unless it is recording at a high rate by itself
+        if self.parameters["logging_rate"] is None:
+            self.logger.log_info(state)
 
-        self.reporting_count += 1
+    def __report_status(self):
+        """
+        Report the flight stats to the GCS as a packed telemetry frame
+        """
+        self.gcs.send_telemetry(self.state, self.fc.get_state())
 
-    def release_package(self):
+    async def release_package(self):
         """
         open the grippers to release the package
         """
         self.report("Releasing parcel.")
-        self.uC.open_grippers()  # blocking function
+        # blocking function so it runs on a worker thread
+        await asyncio.get_running_loop().run_in_executor(None, self.uC.open_grippers)
         self.report("Parcel released.")
 
     def upload_return_mission(self):
@@ -366,7 +624,11 @@ class DroneControl:
         self.report("Button held - preparing script exit.")
 
         # Allow modules to cleanly close their processes
+        self.scheduler.stop()
+        self.safety.close()
         self.logger.close()
+        if self.vision is not None:
+            self.vision.close()
         self.uC.close()
         self.fc.close()
         self.gcs.close()
@@ -377,24 +639,31 @@ class DroneControl:
         self.button.close()
 
 
-if test == "mission":
-    # === INITIALISATION ===
-    # try to initialise drone
-    # if fail then print error and exit program
+async def wait_for_press(button):
+    """
+    Wait for a gpiozero button to be pressed without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    pressed = asyncio.Event()
+    # gpiozero calls when_pressed from its own thread
+    button.when_pressed = lambda: loop.call_soon_threadsafe(pressed.set)
     try:
-        drone = DroneControl()
-    except ValueError as error:
-        print(error)
-        sys.exit()
-    else:
-        drone.report("Initialisation successful.")
-
-    # if exception raised in initialisation then this will not execute because sys.exit()
+        if not button.is_pressed:
+            await pressed.wait()
+    finally:
+        button.when_pressed = None
+
+
+async def fly_missions(drone):
+    """
+    Idle until a command arrives then carry it out, forever.
+    Every wait is on an event - a message, a vehicle update or a button - so idling uses no CPU
+    """
     while True:
         # === IDLE ===
         # state: idle
         drone.abortFlag = False
-        cmd = drone.wait_for_command()
+        cmd = await drone.wait_for_command()
 
         # === SETTING UP FLIGHT ===
         if cmd == 0:
@@ -413,12 +682,12 @@ if test == "mission":
         if drone.abortFlag: continue
 
         # state: wait for battery load
-        drone.battery_load()
+        await drone.battery_load()
 
         if drone.abortFlag: continue
 
         # state: wait for parcel load
-        drone.parcel_load()
+        await drone.parcel_load()
 
         if drone.abortFlag: continue
 
@@ -428,98 +697,120 @@ if test == "mission":
         if drone.abortFlag: continue
 
         # pause for 5 seconds to prevent immediate arming
-        time.sleep(5)
+        await asyncio.sleep(5)
 
         if drone.abortFlag: continue
 
         # state: wait for take off authorisation
-        drone.wait_for_flight_authorisation()
+        await drone.wait_for_flight_authorisation()
 
         if drone.abortFlag: continue
 
         # === FLYING ===
         # state: flying
-        drone.execute_flight()
+        # After a safety command the drone goes back to idle once landed, or exits after an emergency landing
+        if not await drone.execute_flight():
+            if drone.emergency_land:
+                return
+            continue
 
-        drone.release_package()
+        await drone.release_package()
 
         drone.report("Starting return mission.")
 
         drone.upload_return_mission()
 
-        drone.execute_flight()
+        if not await drone.execute_flight():
+            if drone.emergency_land:
+                return
+            continue
 
         drone.report("Flight complete. Drone at home.")
 
-if test == "logging":
-    try:
-        drone = DroneControl()
-    except ValueError as error:
-        print(error)
-        sys.exit()
-    else:
-        drone.report("Initialisation successful.")
 
-    drone.report("Started logging script")
+# The vision worker process imports this module again, so only run a test when started as a script
+if __name__ == '__main__':
+    if test == "mission":
+        # === INITIALISATION ===
+        # try to initialise drone
+        # if fail then print error and exit program
+        try:
+            drone = DroneControl()
+        except ValueError as error:
+            print(error)
+            sys.exit()
+        else:
+            drone.report("Initialisation successful.")
 
-    while True:
-        # Wait for the button press to start data logging
-        drone.report("Short press for logging. Long press to end script.")
-        drone.button.wait_for_press()
-        drone.button.wait_for_release()  # Only start logging when it is pressed and released
+        # if exception raised in initialisation then this will not execute because sys.exit()
+        asyncio.run(fly_missions(drone))
+
+    if test == "logging":
+        try:
+            drone = DroneControl()
+        except ValueError as error:
+            print(error)
+            sys.exit()
+        else:
+            drone.report("Initialisation successful.")
 
-        # Set up and start logging
-        drone.logger.prepare_for_logging(dt.now().strftime("%H-%M-%S_%d-%b"))
-        drone.scheduler.start()
-        drone.report("Logging started")
+        drone.report("Started logging script")
 
-        # Add a minimum logging time
-        time.sleep(5)
+        while True:
+            # Wait for the button press to start data logging
+            drone.report("Short press for logging. Long press to end script.")
+            drone.button.wait_for_press()
+            drone.button.wait_for_release()  # Only start logging when it is pressed and released
 
-        # Wait for the button press to stop data logging
-        drone.button.wait_for_press()
-        drone.button.wait_for_release()
-        drone.scheduler.stop()
-        time.sleep(0.15)
-        drone.logger.finish_logging()
-        drone.report("Logging stopped")
+            # Set up and start logging
+            drone.start_logging(dt.now().strftime("%H-%M-%S_%d-%b"))
+            drone.report("Logging started")
 
-if test == "take off":
-    try:
-        drone = DroneControl()
-    except ValueError as error:
-        print(error)
-        sys.exit()
-    else:
-        drone.report("Initialisation successful.")
+            # Add a minimum logging time
+            time.sleep(5)
+
+            # Wait for the button press to stop data logging
+            drone.button.wait_for_press()
+            drone.button.wait_for_release()
+            drone.stop_logging()
+            drone.report("Logging stopped")
+
+    if test == "take off":
+        try:
+            drone = DroneControl()
+        except ValueError as error:
+            print(error)
+            sys.exit()
+        else:
+            drone.report("Initialisation successful.")
 
-    # state: performing arming check
-    drone.check_armable()
+        # state: performing arming check
+        drone.check_armable()
 
-    # pause for 5 seconds to prevent immediate arming
-    time.sleep(5)
+        # pause for 5 seconds to prevent immediate arming
+        time.sleep(5)
 
-    # state: wait for take off authorisation
-    drone.wait_for_flight_authorisation()
+        # state: wait for take off authorisation
+        asyncio.run(drone.wait_for_flight_authorisation())
 
-    # TAKE-OFF TO 3M
-    drone.fc.vehicle.simple_takeoff(3)
+        # TAKE-OFF TO 3M
+        drone.fc.vehicle.simple_takeoff(3)
 
-    alt = drone.fc.get_altitude()
-    while alt < 2.75:
-        time.sleep(1)
-        drone.report("Still ascending. Current altitude: " + alt)
         alt = drone.fc.get_altitude()
-
-    # HOVER FOR 10 SECONDS
-    drone.fc.change_flight_mode("LOITER")
-    for sec in range(10):
-        drone.report("Hovering. Hover time: " + str(sec + 1) + " seconds")
-
-    # LAND
-    drone.report("Starting to land")
-    drone.fc.land()
-    while drone.fc.vehicle.armed:
-        drone.report("Drone is landing.")
-        time.sleep(1)
-    drone.report("Drone has finished landing.")
+        while alt < 2.75:
+            time.sleep(1)
+            drone.report("Still ascending. Current altitude: " + alt)
+            alt = drone.fc.get_altitude()
+
+        # HOVER FOR 10 SECONDS
+        drone.fc.change_flight_mode("LOITER")
+        for sec in range(10):
+            drone.report("Hovering. Hover time: " + str(sec + 1) + " seconds")
+
+        # LAND
+        drone.report("Starting to land")
+        drone.fc.land()
+        while drone.fc.vehicle.armed:
+            drone.report("Drone is landing.")
+            time.sleep(1)
+        drone.report("Drone has finished landing.")
@@ -0,0 +1,19 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: recover_black_box.py
+# Description: Command line tool to rebuild a clean flight log from the black box after an unclean shutdown
+
+from black_box import recover
+import argparse
+import os
+
+if __name__ == '__main__':
+    default = os.path.dirname(os.path.realpath(__file__)) + "/logging/black_box.bin"
+    parser = argparse.ArgumentParser(description="Rebuild a binary flight log (.flog) from a black box file")
+    parser.add_argument("black_box", nargs="?", default=default, help="black box file (default: logging/black_box.bin)")
+    parser.add_argument("--output", default=None, help="log file to write (default: next to the black box)")
+    args = parser.parse_args()
+
+    path, report = recover(args.black_box, args.output)
+    print(args.black_box + " -> " + path)
+    print("Recovered {records} records, dropped {corrupt} corrupt slots, {gaps} gaps in the sequence".format(**report))
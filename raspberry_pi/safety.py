@@ -0,0 +1,152 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: safety.py
+# Description: Runs safety commands such as emergency land on their own thread within a deadline of receiving them
+
+from instrumentation import LatencyHistogram
+from telemetry import now
+import threading
+import heapq
+import os
+
+
+class SafetyCommand:
+    def __init__(self, name, action, priority, deadline):
+        self.name = name
+        self.action = action
+        self.priority = priority
+        self.deadline = deadline
+        self.reaction = LatencyHistogram()
+        self.stats = {"Count": 0, "Missed deadlines": 0, "Worst reaction": 0.0, "Errors": 0}
+        self.last_error = None
+
+    def get_stats(self):
+        stats = {"Count": self.stats["Count"], "Deadline ms": round(self.deadline * 1000, 1),
+                 "Worst reaction ms": round(self.stats["Worst reaction"] * 1000, 3),
+                 "Missed deadlines": self.stats["Missed deadlines"], "Errors": self.stats["Errors"]}
+        if self.last_error is not None:
+            stats["Last error"] = self.last_error
+        return stats
+
+
+class SafetyExecutor:
+    def __init__(self):
+        """
+        Safety commands run on a thread of their own that does nothing else, so a slow logging or reporting job
+        can never hold them up. trigger() is called straight from the thread that received the command.
+        The reaction time of each command - from being received to its action having been carried out -
+        is measured and checked against the command's deadline.
+        The reaction time is bounded by the time to hand the GIL to this thread (sys.getswitchinterval() for
+        each other busy thread, 5 ms by default) plus the actions of any commands queued ahead of it,
+        so actions must only send commands and never wait for the vehicle to respond
+        """
+        self.commands = {}
+        self.pending = []
+        self.sequence = 0
+        self.is_running = True
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def register(self, name, action, priority=0, deadline=0.1):
+        """
+        Call action() when the command is triggered. Queued commands run lowest priority number first.
+        deadline is the most seconds allowed from receiving the command to action() returning
+        """
+        command = SafetyCommand(name, action, priority, deadline)
+        self.commands[name] = command
+        return command
+
+    def trigger(self, name, received=None):
+        """
+        Queue a registered command to run now. received is when it was received, on the telemetry.now() clock.
+        Return False if the command isn't registered
+        """
+        command = self.commands.get(name)
+        if command is None:
+            return False
+        with self._condition:
+            self.sequence += 1
+            heapq.heappush(self.pending, (command.priority, self.sequence, now() if received is None else received,
+                                          command))
+            self._condition.notify()
+        return True
+
+    def _run(self):
+        try:
+            # Ask the scheduler to run this thread ahead of everything else. Needs root so may well be refused
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(os.sched_get_priority_min(os.SCHED_FIFO)))
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            with self._condition:
+                while self.is_running and not self.pending:
+                    self._condition.wait()
+                if not self.is_running:
+                    return
+                _, _, received, command = heapq.heappop(self.pending)
+
+            try:
+                command.action()
+            except Exception as error:
+                command.stats["Errors"] += 1
+                command.last_error = repr(error)
+            reaction = now() - received
+
+            stats = command.stats
+            stats["Count"] += 1
+            stats["Worst reaction"] = max(stats["Worst reaction"], reaction)
+            if reaction > command.deadline:
+                stats["Missed deadlines"] += 1
+            command.reaction.record(reaction * 1e6)
+
+    def get_stats(self):
+        """
+        Return the count, worst reaction time and deadlines missed of every command
+        """
+        return {name: command.get_stats() for name, command in self.commands.items()}
+
+    def close(self):
+        with self._condition:
+            self.is_running = False
+            self._condition.notify()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    from scheduler import Scheduler
+    import random
+    import time
+
+    def busy(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    # A scheduler job that hogs its thread for 200 ms at a time, which used to delay the emergency land check
+    scheduler = Scheduler()
+    scheduler.start()
+    scheduler.add("slow logging", 0.1, busy, 0.2)
+
+    safety = SafetyExecutor()
+    actions = []
+    safety.register("emergency land", lambda: actions.append("LAND"), priority=0, deadline=0.05)
+    safety.register("abort", lambda: actions.append("LOITER"), priority=1, deadline=0.05)
+
+    # Commands arrive from a reader thread as they would over the serial link
+    for _ in range(50):
+        time.sleep(random.uniform(0.02, 0.1))
+        safety.trigger(random.choice(("emergency land", "abort")))
+    time.sleep(0.1)
+
+    scheduler.stop()
+    safety.close()
+    print(str(len(actions)) + " actions taken")
+    for name, command in safety.commands.items():
+        print(name + ": " + str(command.get_stats()) + " " + str(command.reaction.snapshot()))
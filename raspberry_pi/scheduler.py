@@ -0,0 +1,207 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: scheduler.py
+# Description: Runs many periodic jobs on one thread from absolute deadlines, replacing a thread per tick
+
+import threading
+import math
+import time
+
+# What a job does when it falls a whole interval or more behind its deadlines
+SKIP = "skip"            # Drop the missed runs and stay on the original deadlines
+COALESCE = "coalesce"    # Run once for all the missed runs and restart the deadlines from now
+CATCH_UP = "catch up"    # Make every missed run, back to back, until back on time
+POLICIES = (SKIP, COALESCE, CATCH_UP)
+
+
+class Job:
+    def __init__(self, name, interval, function, args, priority, policy, start):
+        """
+        A function run every interval seconds by a Scheduler. Use Scheduler.add rather than making one directly
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unknown overrun policy: " + str(policy))
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.priority = priority
+        self.policy = policy
+        self.deadline = start
+        self.is_running = False
+        self.stats = {"Runs": 0, "Missed deadlines": 0, "Overruns": 0, "Errors": 0, "Lateness sum": 0.0,
+                      "Lateness sum sq": 0.0, "Max lateness": 0.0, "Run time sum": 0.0, "Max run time": 0.0}
+        self.last_error = None
+
+    def run(self):
+        """
+        Call the function once and move the deadline on according to the overrun policy
+        """
+        stats = self.stats
+        started = time.perf_counter()
+        lateness = started - self.deadline
+        if lateness >= self.interval and self.policy != CATCH_UP:
+            missed = int(lateness // self.interval)
+            stats["Missed deadlines"] += missed
+            lateness -= missed * self.interval
+            if self.policy == SKIP:
+                self.deadline += missed * self.interval
+            else:
+                self.deadline = started
+
+        try:
+            self.function(*self.args)
+        except Exception as error:
+            # One failing job must not stop the watchdogs and everything else sharing the thread
+            stats["Errors"] += 1
+            self.last_error = repr(error)
+        run_time = time.perf_counter() - started
+
+        stats["Runs"] += 1
+        stats["Lateness sum"] += lateness
+        stats["Lateness sum sq"] += lateness * lateness
+        stats["Max lateness"] = max(stats["Max lateness"], lateness)
+        stats["Run time sum"] += run_time
+        stats["Max run time"] = max(stats["Max run time"], run_time)
+        if run_time > self.interval:
+            stats["Overruns"] += 1
+        self.deadline += self.interval
+
+    def get_stats(self):
+        """
+        Return the number of runs, deadlines missed, overruns (runs longer than the interval) and errors,
+        with the lateness of the start times and the run times in ms
+        """
+        stats = self.stats
+        runs = stats["Runs"]
+        summary = {"Runs": runs, "Missed deadlines": stats["Missed deadlines"], "Overruns": stats["Overruns"],
+                   "Errors": stats["Errors"]}
+        if runs == 0:
+            return summary
+        mean = stats["Lateness sum"] / runs
+        jitter = math.sqrt(max(stats["Lateness sum sq"] / runs - mean * mean, 0))
+        summary.update({"Mean lateness ms": round(mean * 1000, 3), "Jitter ms": round(jitter * 1000, 3),
+                        "Max lateness ms": round(stats["Max lateness"] * 1000, 3),
+                        "Mean run ms": round(stats["Run time sum"] / runs * 1000, 3),
+                        "Max run ms": round(stats["Max run time"] * 1000, 3)})
+        if self.last_error is not None:
+            summary["Last error"] = self.last_error
+        return summary
+
+
+class Scheduler:
+    def __init__(self):
+        """
+        Run periodic jobs on a single thread.
+        Every job has absolute deadlines so its rate never drifts however long each run takes.
+        Jobs run one at a time: when several are due the lowest priority number goes first, then the most overdue.
+        A job that runs for longer than the interval of another delays it, and that job's overrun policy decides
+        what happens to the runs it missed
+        """
+        self.jobs = {}
+        self.is_running = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def add(self, name, interval, function, *args, priority=1, policy=SKIP, delay=0):
+        """
+        Call function(*args) every interval seconds, first after delay seconds, until removed.
+        priority 0 is the most urgent. Return the Job, which holds its statistics
+        """
+        with self._condition:
+            if name in self.jobs:
+                raise ValueError("A job called " + name + " is already scheduled")
+            job = Job(name, interval, function, args, priority, policy, time.perf_counter() + delay)
+            self.jobs[name] = job
+            self._condition.notify_all()
+        return job
+
+    def remove(self, name):
+        """
+        Stop running a job. Unless called from a job itself, waits for a run that has already started to finish
+        """
+        with self._condition:
+            job = self.jobs.pop(name, None)
+            if job is None:
+                return None
+            if threading.current_thread() is not self._thread:
+                while job.is_running:
+                    self._condition.wait()
+        return job
+
+    def start(self):
+        if not self.is_running:
+            self.is_running = True
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _next_job(self):
+        """
+        Wait until a job is due and return it, or None once the scheduler has been stopped
+        """
+        with self._condition:
+            while self.is_running:
+                now = time.perf_counter()
+                due = [job for job in self.jobs.values() if job.deadline <= now]
+                if due:
+                    job = min(due, key=lambda job: (job.priority, job.deadline))
+                    job.is_running = True
+                    return job
+                # Woken early if a job is added or the scheduler is stopped
+                deadlines = [job.deadline for job in self.jobs.values()]
+                self._condition.wait(min(deadlines) - now if deadlines else None)
+        return None
+
+    def _run(self):
+        job = self._next_job()
+        while job is not None:
+            job.run()
+            with self._condition:
+                job.is_running = False
+                self._condition.notify_all()
+            job = self._next_job()
+
+    def get_stats(self):
+        """
+        Return the statistics of every job, by name
+        """
+        return {name: job.get_stats() for name, job in list(self.jobs.items())}
+
+    def stop(self):
+        """
+        Stop running jobs once the current run has finished. Can be called from a job
+        """
+        with self._condition:
+            self.is_running = False
+            self._condition.notify_all()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join()
+        self._thread = None
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    scheduler = Scheduler()
+    scheduler.start()
+
+    def busy(seconds):
+        # Stand in for a job such as guidance doing real work
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    # A 100 Hz logger and a watchdog sharing the thread with a slow job that overruns now and then
+    scheduler.add("watchdog", 0.05, busy, 0.0005, priority=0)
+    scheduler.add("logging", 0.01, busy, 0.001, priority=1)
+    slow = iter(range(1000))
+    scheduler.add("reporting", 0.5, lambda: busy(0.03 if next(slow) % 2 else 0.002), priority=2)
+    for policy in POLICIES:
+        scheduler.add(policy, 0.02, busy, 0.001, priority=3, policy=policy)
+    time.sleep(3)
+    scheduler.stop()
+
+    for name, stats in scheduler.get_stats().items():
+        print(name.ljust(10) + str(stats))
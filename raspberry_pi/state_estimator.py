@@ -0,0 +1,162 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: state_estimator.py
+# Description: Kalman filter fusing low rate vision offsets with high rate vehicle velocity
+
+import math
+import time
+
+
+class AxisFilter:
+    def __init__(self, process_noise, vision_noise):
+        """
+        One dimensional Kalman filter for the offset of the pad along one axis.
+        The vehicle velocity is the control input so the state is just the position
+        """
+        self.process_noise = process_noise  # Variance added per second from velocity error and wind
+        self.vision_noise = vision_noise    # Variance of a single vision offset in m^2
+        self.position = 0.0
+        self.variance = math.inf
+
+    def predict(self, velocity, dt):
+        """
+        The pad moves relative to the drone opposite to the drone's own velocity
+        """
+        self.position -= velocity * dt
+        self.variance += self.process_noise * dt
+
+    def update(self, measurement, noise=None):
+        if noise is None:
+            noise = self.vision_noise
+        if self.variance == math.inf:
+            # First measurement simply initialises the filter
+            self.position = measurement
+            self.variance = noise
+            return
+        gain = self.variance / (self.variance + noise)
+        self.position += gain * (measurement - self.position)
+        self.variance *= 1 - gain
+
+
+class PadEstimator:
+    def __init__(self, process_noise=0.05, vision_noise=0.25, max_uncertainty=3.0):
+        """
+        Estimate the position of the landing pad relative to the drone.
+        Coordinates match LandingVision.get_offset: x is to the right and y is forwards, in metres.
+        predict() should be called every control tick with the body velocity from the flight controller,
+        update_vision() whenever a new vision offset is available
+        """
+        self.x = AxisFilter(process_noise, vision_noise)
+        self.y = AxisFilter(process_noise, vision_noise)
+        self.max_uncertainty = max_uncertainty
+        self.last_time = None
+        self.velocity = (0.0, 0.0)
+        self.vision_updates = 0
+
+    def reset(self):
+        self.__init__(self.x.process_noise, self.x.vision_noise, self.max_uncertainty)
+
+    def predict(self, velocity_x, velocity_y, timestamp=None):
+        """
+        Move the estimate forward to timestamp using the drone velocity (right, forwards) in m/s
+        """
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        if self.last_time is not None:
+            dt = timestamp - self.last_time
+            self.x.predict(velocity_x, dt)
+            self.y.predict(velocity_y, dt)
+        self.last_time = timestamp
+        self.velocity = (velocity_x, velocity_y)
+
+    def update_vision(self, offset_x, offset_y, timestamp=None, altitude=None, roll=0.0, pitch=0.0):
+        """
+        Fuse a vision offset taken at timestamp.
+        If altitude is given, the shift in the image caused by the drone's roll and pitch is removed.
+        The offset is moved forward by the velocity for the time since the frame was taken
+        """
+        if altitude is not None:
+            # Rolling right moves the camera's view right so the pad appears further left than it is
+            offset_x += altitude * math.tan(roll)
+            offset_y -= altitude * math.tan(pitch)
+
+        if timestamp is not None and self.last_time is not None:
+            delay = max(self.last_time - timestamp, 0)
+            offset_x -= self.velocity[0] * delay
+            offset_y -= self.velocity[1] * delay
+
+        self.x.update(offset_x)
+        self.y.update(offset_y)
+        self.vision_updates += 1
+
+    def get_estimate(self):
+        """
+        Return the estimated (x, y) offset of the pad and the standard deviation of the estimate in metres.
+        Returns None if there is no estimate or it has become too uncertain to steer on
+        """
+        uncertainty = math.sqrt(max(self.x.variance, self.y.variance))
+        if uncertainty > self.max_uncertainty:
+            return None
+        return self.x.position, self.y.position, uncertainty
+
+
+def replay(events, estimator=None):
+    """
+    Run an estimator over recorded or simulated data.
+    events is a time ordered list of (timestamp, kind, values) where kind is
+    "velocity" with values (vx, vy) or "vision" with values (x, y).
+    Return a list of (timestamp, estimate) after every event
+    """
+    if estimator is None:
+        estimator = PadEstimator()
+
+    estimates = []
+    for timestamp, kind, values in events:
+        if kind == "velocity":
+            estimator.predict(values[0], values[1], timestamp)
+        elif kind == "vision":
+            estimator.predict(estimator.velocity[0], estimator.velocity[1], timestamp)
+            estimator.update_vision(values[0], values[1], timestamp)
+        estimates.append((timestamp, estimator.get_estimate()))
+
+    return estimates
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    import random
+
+    # Simulate the drone drifting over a pad 4 m right and 3 m ahead with velocity at 20 Hz
+    # and a noisy vision offset at 2 Hz. Compare the error of the filter with holding the last vision offset
+    random.seed(1)
+    pad = [4.0, 3.0]
+    events = []
+    truth = []
+    for tick in range(400):
+        t = tick * 0.05
+        velocity = (0.5 * math.sin(t / 3), 0.3 * math.cos(t / 2))
+        pad[0] -= velocity[0] * 0.05
+        pad[1] -= velocity[1] * 0.05
+        events.append((t, "velocity", (velocity[0] + random.gauss(0, 0.05), velocity[1] + random.gauss(0, 0.05))))
+        if tick % 10 == 0:
+            events.append((t, "vision", (pad[0] + random.gauss(0, 0.5), pad[1] + random.gauss(0, 0.5))))
+        truth.append(tuple(pad))
+
+    fused_error = 0
+    held_error = 0
+    held = None
+    position = iter(truth)
+    for (t, kind, values), (_, estimate) in zip(events, replay(events)):
+        if kind == "vision":
+            held = values
+            continue
+        x, y = next(position)
+        if held is not None:
+            held_error += (held[0] - x) ** 2 + (held[1] - y) ** 2
+            fused_error += (estimate[0] - x) ** 2 + (estimate[1] - y) ** 2
+
+    print("RMS error at 20 Hz - last vision offset: {:.2f} m, fused: {:.2f} m".format(
+        math.sqrt(held_error / len(truth)), math.sqrt(fused_error / len(truth))))
@@ -0,0 +1,223 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: telemetry.py
+# Description: Typed record of the vehicle state, read once per tick and shared by logging, reporting and control
+
+import math
+import time
+
+# Epoch time at which perf_counter read zero, so that now() is in epoch seconds
+# but never jumps like time.time() can when the clock is set - see resync_clock
+CLOCK_OFFSET = time.time() - time.perf_counter()
+
+
+def now():
+    """
+    Monotonic high resolution timestamp in seconds since the epoch
+    """
+    return CLOCK_OFFSET + time.perf_counter()
+
+
+def resync_clock():
+    """
+    Take the epoch of now() from the system clock again. The Pi has no real time clock so its clock is only
+    right once the GCS handshake has set it, after this module was imported. now() only jumps when this is called
+    """
+    global CLOCK_OFFSET
+    CLOCK_OFFSET = time.time() - time.perf_counter()
+
+
+# Fields that arrive together from the vehicle, each group with its own receive time
+GROUPS = {"position": ("lat", "lon", "alt", "velocity_north", "velocity_east", "velocity_down"),
+          "attitude": ("roll", "pitch", "yaw"),
+          "speed": ("groundspeed", "airspeed"),
+          "battery": ("voltage", "current"),
+          "rangefinder": ("rangefinder",)}
+
+
+class Telemetry:
+    # Fixed attributes so a sample is small and can be refilled in place every tick
+    __slots__ = ("timestamp", "lat", "lon", "alt", "rangefinder", "distance_left",
+                 "velocity_north", "velocity_east", "velocity_down", "groundspeed", "airspeed",
+                 "voltage", "current", "roll", "pitch", "yaw",
+                 "position_time", "attitude_time", "speed_time", "battery_time", "rangefinder_time")
+
+    def __init__(self):
+        """
+        All values are floats in SI units and radians. Anything not known yet is NaN.
+        lat and lon are named as in dronekit so a sample can be passed to get_distance_metres.
+        timestamp is when the sample was taken and each group of fields - see GROUPS - has the
+        time its values were received, on the same clock, so stale values can be told apart
+        """
+        for name in self.__slots__:
+            setattr(self, name, math.nan)
+
+    def update(self, vehicle):
+        """
+        Refill the sample in place from a dronekit vehicle.
+        distance_left is left for FlightController to fill in as it knows the destination
+        """
+        self.timestamp = now()
+
+        location = vehicle.location
+        frame = location.global_frame
+        self.lat = _number(frame.lat)
+        self.lon = _number(frame.lon)
+        self.alt = _number(location.global_relative_frame.alt)
+        self.rangefinder = _number(vehicle.rangefinder.distance)
+
+        velocity = vehicle.velocity
+        if velocity:
+            self.velocity_north = _number(velocity[0])
+            self.velocity_east = _number(velocity[1])
+            self.velocity_down = _number(velocity[2])
+        self.groundspeed = _number(vehicle.groundspeed)
+        self.airspeed = _number(vehicle.airspeed)
+
+        battery = vehicle.battery
+        self.voltage = _number(battery.voltage)
+        self.current = _number(battery.current)
+
+        attitude = vehicle.attitude
+        self.roll = _number(attitude.roll)
+        self.pitch = _number(attitude.pitch)
+        self.yaw = _number(attitude.yaw)
+
+        # Everything was read just now
+        for group in GROUPS:
+            setattr(self, group + "_time", self.timestamp)
+        return self
+
+    def age(self, group):
+        """
+        Seconds since the values of a group were received, NaN if they never have been
+        """
+        return now() - getattr(self, group + "_time")
+
+    def velocity_body(self):
+        """
+        Return the horizontal velocity in m/s as (right, forwards)
+        to match the axes of the landing vision offsets
+        """
+        cos_yaw = math.cos(self.yaw)
+        sin_yaw = math.sin(self.yaw)
+        forwards = self.velocity_north * cos_yaw + self.velocity_east * sin_yaw
+        right = -self.velocity_north * sin_yaw + self.velocity_east * cos_yaw
+        return right, forwards
+
+    def status_message(self, state):
+        """
+        One line summary for the ground control station
+        """
+        return "State: " + state.ljust(10) \
+               + "  |  Altitude: " + "{:.2f}".format(self.alt).ljust(6) \
+               + "  |  Remaining Distance: " + "{:.0f}".format(self.distance_left).ljust(4) \
+               + "  |  Speed: " + "{:.2f}".format(self.groundspeed).ljust(5) \
+               + "  |  Battery Voltage (V): " + "{:.2f}".format(self.voltage).ljust(5) \
+               + "  |  Battery Current (A): " + "{:.0f}".format(self.current).ljust(5)
+
+    def freeze(self):
+        """
+        Return a read only copy that is safe to share between threads and keep
+        """
+        snapshot = object.__new__(TelemetrySnapshot)
+        for name in Telemetry.__slots__:
+            object.__setattr__(snapshot, name, getattr(self, name))
+        return snapshot
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in Telemetry.__slots__}
+
+
+class TelemetrySnapshot(Telemetry):
+    # No attributes of its own so it is laid out exactly like Telemetry
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("A telemetry snapshot is read only")
+
+
+def _number(value):
+    """
+    dronekit gives None for anything it hasn't received yet
+    """
+    return math.nan if value is None else value
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    from types import SimpleNamespace
+    import tracemalloc
+
+    # Stand in for a dronekit vehicle
+    frame = SimpleNamespace(lat=52.3899529, lon=-1.5621087)
+    vehicle = SimpleNamespace(location=SimpleNamespace(global_frame=frame,
+                                                       global_relative_frame=SimpleNamespace(alt=10.02)),
+                              rangefinder=SimpleNamespace(distance=9.8),
+                              velocity=[0.51, -0.12, 0.03], groundspeed=0.52, airspeed=0.6,
+                              battery=SimpleNamespace(voltage=16.2, current=12.5),
+                              attitude=SimpleNamespace(roll=0.01, pitch=-0.02, yaw=1.2))
+
+    def string_tick():
+        # What every monitor tick used to do: stringify everything, then parse some of it back for the report
+        fc_stats = {"Location lat": str(vehicle.location.global_frame.lat),
+                    "Location lon": str(vehicle.location.global_frame.lon),
+                    "Location alt": str(vehicle.location.global_relative_frame.alt),
+                    "Range Finder Height": str(vehicle.rangefinder),
+                    "Distance to waypoint": str(12.3),
+                    "Velocity": str(vehicle.velocity),
+                    "Battery": str(vehicle.battery.voltage),
+                    "Groundspeed": str(vehicle.groundspeed),
+                    "Airspeed": str(vehicle.airspeed)}
+        data = {"Location lon": fc_stats["Location lon"],
+                "Velocity": "\"" + fc_stats["Velocity"] + "\"",
+                "Current": str(vehicle.battery.current)}
+        return ', '.join(data.values()), round(float(fc_stats["Groundspeed"]), 2)
+
+    sample = Telemetry()
+
+    def record_tick():
+        sample.update(vehicle)
+        sample.distance_left = 12.3
+        return sample.velocity_body()
+
+    for name, tick in ("Strings", string_tick), ("Telemetry", record_tick):
+        tick()
+        # Peak traced memory over a single tick is the most that tick had allocated at once
+        tracemalloc.start()
+        peak = 0
+        for _ in range(1000):
+            tracemalloc.reset_peak()
+            tick()
+            peak += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for _ in range(1000):
+            tick()
+        print("{}: {:.1f} us and {:.0f} bytes allocated per tick".format(
+            name, (time.perf_counter() - start) * 1000, peak / 1000))
+
+    print(sample.status_message("Descent"))
+
+    # Sharing a snapshot costs a copy per refresh rather than a read of the vehicle per consumer
+    start = time.perf_counter()
+    for _ in range(1000):
+        snapshot = sample.freeze()
+    print("Freeze: {:.1f} us".format((time.perf_counter() - start) * 1000))
+    try:
+        snapshot.alt = 0
+    except AttributeError as error:
+        print(error)
+
+    # now() keeps its epoch until resynced, then follows the clock being set e.g. by the GCS handshake
+    real_time = time.time
+    time.time = lambda: real_time() + 3600
+    print("now() before resync is " + "{:.0f}".format(time.time() - now()) + " s behind the clock")
+    resync_clock()
+    print("now() after resync is " + "{:.3f}".format(time.time() - now()) + " s behind the clock")
+    time.time = real_time
+    resync_clock()
@@ -0,0 +1,219 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: vision_benchmark.py
+# Description: Offline benchmark to time a vision engine and score its accuracy over a corpus of images
+
+import cv2
+import numpy as np
+from landing_vision_2 import HORIZONTAL_FOV, VERTICAL_FOV
+from multiprocessing import Pool
+import importlib
+import argparse
+import resource
+import json
+import glob
+import math
+import time
+import os
+
+# Each worker process builds its own engine once and reuses it for every image
+engine = None
+
+
+def load_engine(engine_spec, engine_kwargs):
+    """
+    Build a vision engine from a "module:Class" string.
+    Any class with a get_offset(altitude, ground_in) method can be benchmarked
+    """
+    module_name, class_name = engine_spec.split(":")
+    engine_class = getattr(importlib.import_module(module_name), class_name)
+    return engine_class(**engine_kwargs)
+
+
+def init_worker(engine_spec, engine_kwargs):
+    global engine
+    engine = load_engine(engine_spec, engine_kwargs)
+
+
+def run_image(task):
+    """
+    Run the engine over one image a number of times.
+    Return the latency of each run, the offset found and the peak memory of this worker
+    """
+    path, altitude, repeat = task
+    ground = cv2.imread(path, cv2.IMREAD_COLOR)
+
+    latencies = []
+    offset = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        offset = engine.get_offset(altitude, ground)
+        latencies.append(time.perf_counter() - start)
+
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kB on Linux
+    return {"image": os.path.basename(path),
+            "shape": ground.shape[:2],
+            "latencies": latencies,
+            "offset": [float(offset[0]), float(offset[1])],
+            "peak_memory_kb": peak_memory}
+
+
+def expected_offset(pad_centre, shape, altitude):
+    """
+    Convert a labelled pad centre in pixels into the offset in metres the engine should return
+    """
+    height, width = shape
+    half_ground_width = altitude * math.tan(math.radians(HORIZONTAL_FOV / 2))
+    half_ground_height = altitude * math.tan(math.radians(VERTICAL_FOV / 2))
+    x = (pad_centre[0] - width / 2) / (width / 2) * half_ground_width
+    y = (height / 2 - pad_centre[1]) / (height / 2) * half_ground_height
+    return x, y
+
+
+def load_annotations(directory):
+    """
+    Return the ground truth labels stored next to the images, if there are any
+    """
+    path = os.path.join(directory, "annotations.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def score(results, annotations):
+    """
+    Compare each offset found with the ground truth.
+    The engines return (0, 0) when no pad is found so this counts as a miss
+    """
+    altitude = annotations.get("altitude", 30)
+    errors = []
+    misses = 0
+    false_positives = 0
+
+    for result in results:
+        label = annotations["images"].get(result["image"])
+        if label is None:
+            continue
+
+        detected = result["offset"] != [0, 0]
+        if label["pad_centre"] is None:
+            false_positives += detected
+            continue
+        if not detected:
+            misses += 1
+            continue
+
+        truth = expected_offset(label["pad_centre"], result["shape"], altitude)
+        error = math.hypot(result["offset"][0] - truth[0], result["offset"][1] - truth[1])
+        result["error_m"] = round(error, 3)
+        errors.append(error)
+
+    return {"images_scored": len(errors) + misses + false_positives,
+            "misses": misses,
+            "false_positives": false_positives,
+            "mean_error_m": float(np.mean(errors)) if errors else None,
+            "max_error_m": float(np.max(errors)) if errors else None}
+
+
+def benchmark(engine_spec="landing_vision_2:LandingVision", engine_kwargs=None, directory=None,
+              pattern="test_image_*.jpg", altitude=None, repeat=5, workers=None):
+    """
+    Run the engine over every image in the directory across a pool of processes
+    and return a dictionary of the latency, throughput, memory and accuracy results
+    """
+    if engine_kwargs is None:
+        engine_kwargs = {}
+    if directory is None:
+        directory = os.path.dirname(os.path.realpath(__file__)) + "/images"
+
+    annotations = load_annotations(directory)
+    if altitude is None:
+        altitude = annotations.get("altitude", 30) if annotations else 30
+
+    paths = sorted(glob.glob(os.path.join(directory, pattern)))
+    tasks = [(path, altitude, repeat) for path in paths]
+
+    start = time.perf_counter()
+    with Pool(workers, initializer=init_worker, initargs=(engine_spec, engine_kwargs)) as pool:
+        results = pool.map(run_image, tasks)
+    wall_time = time.perf_counter() - start
+
+    latencies = np.array([latency for result in results for latency in result["latencies"]]) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+    report = {"engine": engine_spec,
+              "engine_kwargs": engine_kwargs,
+              "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "images": len(paths),
+              "frames": len(latencies),
+              "workers": workers or os.cpu_count(),
+              "latency_ms": {"p50": round(p50, 2), "p95": round(p95, 2), "p99": round(p99, 2),
+                             "mean": round(float(latencies.mean()), 2)},
+              "fps_per_worker": round(1000 / float(latencies.mean()), 2),
+              "fps_total": round(len(latencies) / wall_time, 2),
+              "peak_memory_mb": round(max(result["peak_memory_kb"] for result in results) / 1024, 1)}
+
+    if annotations is not None:
+        report["accuracy"] = score(results, annotations)
+
+    for result in results:
+        result.pop("latencies")
+        result["shape"] = list(result["shape"])
+    report["per_image"] = results
+
+    return report
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    Print any latency that has got worse than the baseline by more than the tolerance
+    """
+    regressed = False
+    for key in "p50", "p95", "p99":
+        old = baseline["latency_ms"][key]
+        new = report["latency_ms"][key]
+        change = (new - old) / old if old else 0
+        print("  " + key + ": " + str(old) + " ms -> " + str(new) + " ms (" + format(change, "+.0%") + ")")
+        if change > tolerance:
+            regressed = True
+    return regressed
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark a vision engine over a corpus of images")
+    parser.add_argument("--engine", default="landing_vision_2:LandingVision", help="module:Class to benchmark")
+    parser.add_argument("--engine-kwargs", default="{}", help="JSON keyword arguments for the engine")
+    parser.add_argument("--images", default=None, help="directory of images (default: images/)")
+    parser.add_argument("--pattern", default="test_image_*.jpg")
+    parser.add_argument("--altitude", type=float, default=None)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per image")
+    parser.add_argument("--workers", type=int, default=None, help="processes in the pool (default: all cores)")
+    parser.add_argument("--output", default="vision_benchmark.json")
+    parser.add_argument("--baseline", default=None, help="previous results file to compare against")
+    args = parser.parse_args()
+
+    results = benchmark(args.engine, json.loads(args.engine_kwargs), args.images, args.pattern,
+                        args.altitude, args.repeat, args.workers)
+
+    print("Latency (ms): " + str(results["latency_ms"]))
+    print("FPS: " + str(results["fps_per_worker"]) + " per worker, " + str(results["fps_total"]) + " total")
+    print("Peak memory: " + str(results["peak_memory_mb"]) + " MB")
+    if "accuracy" in results:
+        print("Accuracy: " + str(results["accuracy"]))
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print("Results written to " + args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        print("Compared to " + args.baseline + ":")
+        if compare(results, baseline):
+            print("Performance regression detected")
+            raise SystemExit(1)
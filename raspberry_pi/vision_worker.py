@@ -0,0 +1,303 @@
+# ES410 Autonomous Drone
+# Owner: William Gower
+# File: vision_worker.py
+# Description: Module to run the landing vision in its own process with frames and results in shared memory
+
+import numpy as np
+from multiprocessing import shared_memory
+import multiprocessing
+from frame_source import FrameGrabber
+from frame_gate import FrameGate, GATE_RESULTS
+from landing_targets import read_pad_list
+from instrumentation import LatencyHistogram, BUCKETS
+import time
+
+# The tracking statistics copied from LandingVision.get_tracking_stats, which only the worker can call
+TRACKING_FIELDS = ("Frames", "ROI searches", "ROI hits", "Full searches", "Full hits", "Search area",
+                   "Total search area", "ROI hit rate", "Hit rate", "Mean search area")
+
+# Layout of the control block shared between the processes
+LATEST_INDEX = 0    # Ring slot of the newest frame, -1 before the first frame
+HELD_INDEX = 1      # Ring slot the worker is currently reading, -1 if none
+ALTITUDE = 2        # Latest vehicle altitude
+RESET_TRACKING = 3  # Set to 1 by the main process to make the worker forget the last pad position
+ROLL = 4            # Latest vehicle attitude in radians
+PITCH = 5
+RESET_STATS = 6     # Set to 1 by the main process to zero the gate counters and tracking statistics
+EXPECTED_PAD = 7    # Index into the pad list of the pad to search for, -1 for any
+GATE_COUNTS = 8     # One counter per entry in GATE_RESULTS follows
+TRACKING = GATE_COUNTS + len(GATE_RESULTS)  # One value per entry in TRACKING_FIELDS follows
+CAPTURES = TRACKING + len(TRACKING_FIELDS)  # CAPTURE_FIELDS of each slot follow
+# Then a LatencyHistogram of the time taken to locate the pad in each frame
+
+# Copied from the latest vehicle state as each frame is captured, so a frame is always gated and
+# converted to metres with the altitude and attitude it was taken at
+CAPTURE_FIELDS = ("frame_time", "altitude", "roll", "pitch")
+
+# Layout of the result block, only read or written holding the lock shared by the processes.
+# sequence counts the results and pad is the index into the pad list of the pad that was found
+RESULT_FIELDS = ("sequence", "found", "x", "y", "yaw", "confidence", "pad",
+                 "altitude", "roll", "pitch", "frame_time", "result_time")
+
+
+def worker_main(names, shape, vision_kwargs, new_frame, stop, lock):
+    """
+    Entry point of the worker process.
+    Every time a frame arrives it is gated and, if usable, the vision is run on it and the pose published
+    """
+    # Only the worker process needs OpenCV and the descriptor bank
+    from landing_vision_2 import LandingVision
+
+    frames_shm = shared_memory.SharedMemory(name=names[0])
+    control_shm = shared_memory.SharedMemory(name=names[1])
+    result_shm = shared_memory.SharedMemory(name=names[2])
+    frames = np.ndarray(shape, dtype=np.uint8, buffer=frames_shm.buf)
+    histogram_start = CAPTURES + len(CAPTURE_FIELDS) * shape[0]
+    control = np.ndarray(histogram_start + BUCKETS, dtype=np.float64, buffer=control_shm.buf)
+    captures = control[CAPTURES:histogram_start].reshape(shape[0], len(CAPTURE_FIELDS))
+    result = np.ndarray(len(RESULT_FIELDS), dtype=np.float64, buffer=result_shm.buf)
+
+    vision = LandingVision(**vision_kwargs)
+    gate = FrameGate()
+    names = vision.registry.names
+    expected_pad = -1
+    latency = LatencyHistogram(control[histogram_start:])
+
+    while not stop.is_set():
+        if not new_frame.wait(0.1):
+            continue
+        new_frame.clear()
+
+        if control[RESET_TRACKING]:
+            vision.reset_tracking()
+            control[RESET_TRACKING] = 0
+
+        if control[RESET_STATS]:
+            gate.reset()
+            vision.reset_tracking_stats()
+            with lock:
+                control[TRACKING:CAPTURES] = _tracking_values(vision)
+            control[RESET_STATS] = 0
+
+        if control[EXPECTED_PAD] != expected_pad:
+            expected_pad = int(control[EXPECTED_PAD])
+            vision.expect_pad(names[expected_pad] if expected_pad >= 0 else None)
+
+        # Hold the slot so the capture thread doesn't overwrite it while it is being processed.
+        # Taking the lock also makes sure the whole frame written before it was published is seen
+        with lock:
+            index = int(control[LATEST_INDEX])
+            control[HELD_INDEX] = index
+            frame_time, altitude, roll, pitch = captures[index].tolist()
+
+        # Only spend time matching frames that are level, sharp and well exposed
+        accepted = gate.check(frames[index], roll, pitch) == "Accepted"
+        counts = [gate.counts[key] for key in GATE_RESULTS]
+        if not accepted:
+            with lock:
+                control[GATE_COUNTS:TRACKING] = counts
+                control[HELD_INDEX] = -1
+            continue
+
+        start = time.perf_counter_ns()
+        pose = vision.get_pose(altitude, frames[index])
+        latency.record((time.perf_counter_ns() - start) // 1000)
+
+        if pose is None:
+            values = (0, 0, 0, 0, 0, -1)
+        else:
+            values = (1, pose[0], pose[1], pose[2], pose[3], names.index(vision.location))
+        tracking = _tracking_values(vision)
+        with lock:
+            control[GATE_COUNTS:TRACKING] = counts
+            control[TRACKING:CAPTURES] = tracking
+            control[HELD_INDEX] = -1
+            result[0] += 1
+            result[1:7] = values
+            result[7:12] = (altitude, roll, pitch, frame_time, time.perf_counter())
+
+    del frames, control, captures, result
+    frames_shm.close()
+    control_shm.close()
+    result_shm.close()
+
+
+def _tracking_values(vision):
+    stats = vision.get_tracking_stats()
+    return [stats[key] for key in TRACKING_FIELDS]
+
+
+class VisionWorker:
+    def __init__(self, frame_source, vision_kwargs=None, buffer_count=4):
+        """
+        Run LandingVision in a dedicated process so it doesn't share the GIL with logging and serial polling.
+        Frames are captured by a thread in this process straight into shared memory and the
+        worker writes its results back into shared memory, so no image is ever pickled.
+        The worker is spawned rather than forked as the flight controller and GCS threads may already be
+        running, so the module that creates this must only start the flight when run as __main__.
+        Values that go together - a published frame, the gate counts and a result - are only read or written
+        holding a lock shared by the processes. The Pi's ARM cores can make stores visible to the other
+        process out of order, which the lock prevents, so a reader never sees half of an update
+        """
+        if vision_kwargs is None:
+            vision_kwargs = {}
+        # Both processes read the same list so a pad can be passed between them by index
+        self.pad_names = [name for name, _ in vision_kwargs.get("pads") or read_pad_list()]
+        width, height = frame_source.resolution
+        shape = (buffer_count, height, width, 3)
+
+        self.frames_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        histogram_start = CAPTURES + len(CAPTURE_FIELDS) * buffer_count
+        self.control_shm = shared_memory.SharedMemory(create=True, size=8 * (histogram_start + BUCKETS))
+        self.result_shm = shared_memory.SharedMemory(create=True, size=8 * len(RESULT_FIELDS))
+        self.frames = np.ndarray(shape, dtype=np.uint8, buffer=self.frames_shm.buf)
+        self.control = np.ndarray(histogram_start + BUCKETS, dtype=np.float64, buffer=self.control_shm.buf)
+        self.captures = self.control[CAPTURES:histogram_start].reshape(buffer_count, len(CAPTURE_FIELDS))
+        self.result = np.ndarray(len(RESULT_FIELDS), dtype=np.float64, buffer=self.result_shm.buf)
+        self.control[:] = 0
+        self.control[LATEST_INDEX] = -1
+        self.control[HELD_INDEX] = -1
+        self.control[EXPECTED_PAD] = -1
+        self.result[:] = 0
+        # Written by the worker, readable here at any time
+        self.latency = LatencyHistogram(self.control[histogram_start:])
+
+        context = multiprocessing.get_context("spawn")
+        self.new_frame = context.Event()
+        self.stop_event = context.Event()
+        self.lock = context.Lock()
+        names = (self.frames_shm.name, self.control_shm.name, self.result_shm.name)
+        self.process = context.Process(target=worker_main, daemon=True,
+                                       args=(names, shape, vision_kwargs, self.new_frame, self.stop_event, self.lock))
+        self.process.start()
+
+        self.grabber = FrameGrabber(frame_source, buffers=self.frames, on_frame=self._publish_frame,
+                                    held_index=self._held_index)
+        self.grabber.start()
+
+    def _publish_frame(self, index, timestamp):
+        """
+        Called by the capture thread after a frame is written to shared memory.
+        Tags the frame with the vehicle state at the time it was captured
+        """
+        control = self.control
+        with self.lock:
+            self.captures[index] = (timestamp, control[ALTITUDE], control[ROLL], control[PITCH])
+            control[LATEST_INDEX] = index
+        self.new_frame.set()
+
+    def _held_index(self):
+        with self.lock:
+            return int(self.control[HELD_INDEX])
+
+    def set_altitude(self, altitude):
+        """
+        Latest altitude, given to each frame as it is captured. Call whenever a new altitude arrives
+        """
+        self.control[ALTITUDE] = altitude
+
+    def set_attitude(self, roll, pitch):
+        """
+        Latest roll and pitch in radians, given to each frame as it is captured.
+        Frames taken at too steep an angle are skipped. Call whenever a new attitude arrives
+        """
+        self.control[ROLL] = roll
+        self.control[PITCH] = pitch
+
+    def get_gate_stats(self):
+        """
+        Return the number of frames accepted and rejected for each reason since the last reset
+        """
+        with self.lock:
+            counts = self.control[GATE_COUNTS:TRACKING].astype(int).tolist()
+        return dict(zip(GATE_RESULTS, counts))
+
+    def get_tracking_stats(self):
+        """
+        Return the worker's region of interest tracking statistics since the last reset
+        - see LandingVision.get_tracking_stats
+        """
+        with self.lock:
+            values = self.control[TRACKING:CAPTURES].tolist()
+        stats = dict(zip(TRACKING_FIELDS, values))
+        for key in "Frames", "ROI searches", "ROI hits", "Full searches", "Full hits":
+            stats[key] = int(stats[key])
+        return stats
+
+    def reset_stats(self):
+        """
+        Zero the gate counters and tracking statistics e.g. at the start of a flight
+        """
+        self.control[RESET_STATS] = 1
+
+    def reset_tracking(self):
+        self.control[RESET_TRACKING] = 1
+
+    def expect_pad(self, location):
+        """
+        Only search for the pad of this location from now on.
+        Every pad is searched for if location is None or has no pad of its own in the list.
+        Can be given as a destination listener to FlightController
+        """
+        self.control[EXPECTED_PAD] = self.pad_names.index(location) if location in self.pad_names else -1
+
+    def latest_result(self):
+        """
+        Non-blocking. Return the newest result as a dictionary with keys RESULT_FIELDS,
+        or None if nothing has been processed yet.
+        frame_time and result_time are perf_counter times so the age of a result is easy to check
+        """
+        with self.lock:
+            values = self.result.tolist()
+
+        if values[0] == 0:
+            return None
+        result = dict(zip(RESULT_FIELDS, values))
+        result["sequence"] = int(result["sequence"])
+        result["found"] = bool(result["found"])
+        result["pad"] = self.pad_names[int(result["pad"])] if result["found"] else None
+        return result
+
+    def close(self):
+        """
+        prepare for system shutdown
+        stop the capture and the worker process then release the shared memory
+        """
+        self.grabber.stop()
+        self.stop_event.set()
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.terminate()
+
+        del self.frames, self.control, self.captures, self.result, self.latency
+        for shm in self.frames_shm, self.control_shm, self.result_shm:
+            shm.close()
+            shm.unlink()
+
+
+########################################
+#           MODULE TESTBENCH           #
+########################################
+
+if __name__ == '__main__':
+    from frame_source import SyntheticSource
+
+    worker = VisionWorker(SyntheticSource(framerate=10), {"tracking": True})
+    worker.set_altitude(10)
+
+    # The main process stays free while the worker runs - poll the latest result at 20 Hz
+    last_sequence = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < 5:
+        result = worker.latest_result()
+        if result is not None and result["sequence"] != last_sequence:
+            last_sequence = result["sequence"]
+            print("Result " + str(last_sequence) + ": found " + str(result["found"])
+                  + ", offset (" + str(round(result["x"], 2)) + ", " + str(round(result["y"], 2)) + ")"
+                  + ", latency " + str(round((result["result_time"] - result["frame_time"]) * 1000)) + " ms")
+        time.sleep(0.05)
+
+    print(worker.get_gate_stats())
+    print(worker.get_tracking_stats())
+    print(worker.latency.snapshot())
+    worker.close()